@@ -7,7 +7,7 @@ For help with individual commands, run ``aegea <command> --help``.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, argparse, logging, shutil, json, datetime, traceback, errno, warnings
+import os, sys, argparse, logging, shutil, json, datetime, traceback, errno, warnings, copy
 from textwrap import fill
 import tweak
 from botocore.exceptions import NoRegionError
@@ -75,7 +75,10 @@ def main(args=None):
     if has_attrs and parsed_args.sort_by not in parsed_args.columns:
         parsed_args.columns.append(parsed_args.sort_by)
     try:
-        result = parsed_args.entry_point(parsed_args)
+        if getattr(parsed_args, "regions", None):
+            result = run_in_regions(parsed_args)
+        else:
+            result = parsed_args.entry_point(parsed_args)
     except Exception as e:
         if isinstance(e, NoRegionError):
             msg = "The AWS CLI is not configured."
@@ -102,6 +105,38 @@ def main(args=None):
             del result["ResponseMetadata"]
         print(json.dumps(result, indent=2, default=lambda x: str(x)))
 
+def run_in_regions(parsed_args):
+    """
+    Run a listing command concurrently in each of the regions given by --regions, and print the rows that it
+    tabulates in all regions as one table with a leading region column.
+    """
+    from .util import ThreadPoolExecutor
+    from .util.aws import in_region, resolve_regions
+    from .util.printing import collect_rows, format_cells, page_output
+    regions = resolve_regions(parsed_args.regions)
+
+    def run(region):
+        # Entry points modify their arguments (e.g. the column list), so each region gets its own copy
+        region_args = copy.deepcopy(parsed_args)
+        with in_region(region), collect_rows() as collector:
+            try:
+                return region_args.entry_point(region_args), collector, None
+            except Exception as e:
+                logger.warn("%s: %s: %s", region, e.__class__.__name__, e)
+                return None, collector, e
+
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        results = list(executor.map(run, regions))
+    if all(error is not None for result, collector, error in results):
+        raise results[0][2]
+    table = [[region] + row for region, (result, collector, error) in zip(regions, results) for row in collector.rows]
+    columns = next((collector.columns for result, collector, error in results if collector.columns), None)
+    if columns is not None:
+        parsed_args.columns = ["region"] + columns
+        page_output(format_cells(table, parsed_args))
+    results = {region: result for region, (result, collector, error) in zip(regions, results) if result is not None}
+    return results or None
+
 def register_parser(function, parent=None, name=None, **add_parser_args):
     if config is None:
         initialize()
@@ -4,114 +4,211 @@ Manage AWS Batch jobs, queues, and compute environments.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, argparse, base64, collections, io, subprocess, json, time, re, hashlib
+import os, sys, argparse, base64, collections, io, subprocess, json, time, re, hashlib, heapq, csv, copy, threading
+import math
 from datetime import datetime
 
 from botocore.exceptions import ClientError
 import yaml
 
-from . import logger
+from . import logger, config
 from .ls import register_parser, register_listing_parser
 from .ecr import ecr_image_name_completer
-from .util import Timestamp, paginate
+from .util import constants, Timestamp, paginate, chunked, add_time_bound_args, ThreadPoolExecutor, RateLimiter
 from .util.crypto import ensure_ssh_key
+from .util.compat import lru_cache, timestamp, shell_quote
+from .util.cache import JSONCache
 from .util.exceptions import AegeaException
-from .util.printing import page_output, tabulate, YELLOW, RED, GREEN, BOLD, ENDC
+from .util.printing import page_output, tabulate, format_table, YELLOW, RED, GREEN, BOLD, ENDC
 from .util.aws import (ARN, resources, clients, expect_error_codes, ensure_iam_role, ensure_instance_profile,
                        make_waiter, ensure_vpc, ensure_security_group, ensure_s3_bucket, ensure_log_group,
-                       IAMPolicyBuilder, resolve_ami)
+                       IAMPolicyBuilder, resolve_ami, EnsuredResources, reverify_ensured_resources_on_error,
+                       upload_content_addressed, availability_zones)
 from .util.aws.spot import SpotFleetBuilder
+from .util.aws.logs import LogWriter, add_log_format_arg
+from .util.aws.batch import (JobStore, JobArchive, list_all_jobs, list_array_job_children, get_array_status_summary,
+                             get_job_queue_names, terminal_job_states)
 
 bash_cmd_preamble = ["/bin/bash", "-c", 'for i in "$@"; do eval "$i"; done', __name__]
 
 ebs_vol_mgr_shellcode = """apt-get update -qq
-apt-get install -qqy --no-install-suggests --no-install-recommends httpie awscli jq psmisc lsof
+apt-get install -qqy --no-install-suggests --no-install-recommends httpie awscli jq psmisc lsof%(packages)s
 
 iid=$(http http://169.254.169.254/latest/dynamic/instance-identity/document)
 aws configure set default.region $(echo "$iid" | jq -r .region)
 az=$(echo "$iid" | jq -r .availabilityZone)
+instance_id=$(echo "$iid" | jq -r .instanceId)
 
-echo Creating volume >&2
-vid=$(aws ec2 create-volume --availability-zone $az --size %s --volume-type st1 | jq -r .VolumeId)
-aws ec2 create-tags --resource $vid --tags Key=aegea_batch_job,Value=$AWS_BATCH_JOB_ID
+# Device nodes are handed out from a registry of slots on the host's /dev, which is shared by all containers that mount
+# it. A slot is claimed by writing the job ID into it under an exclusive lock, and the ID of the volume attached on its
+# device node is added once the attachment succeeds (record_volume). Slots are released when the job exits.
+# Slots whose device node does not exist yet are skipped while their claim is less than 10 minutes old (the attachment
+# is in progress), and are reclaimed after that (the job that claimed them was killed before it could release them).
+slots=/dev/aegea_ebs_slots
+pool=%(storage_pool)s
+stripes=%(stripes)s
+vids=
+devnodes=
+reserved_devnode=
+device=
+claimed_slots=
+mkdir -p $slots
+allocate_devnode() { \
+    echo Allocating a device node >&2; \
+    exec 9>$slots/.lock; \
+    flock 9; \
+    devnode=; \
+    for candidate in "$@"; do \
+        slot=$slots/${candidate#/dev/}; \
+        if [[ -e $candidate ]] || [[ -f $slot && -z $(find $slot -mmin +10) ]]; then \
+            continue; \
+        fi; \
+        echo $AWS_BATCH_JOB_ID > $slot; \
+        claimed_slots="$claimed_slots $slot"; \
+        devnode=$candidate; \
+        break; \
+    done; \
+    exec 9>&-; \
+    if [[ -z $devnode ]]; then \
+        echo "No free device node on instance $instance_id" >&2; \
+        exit 1; \
+    fi; \
+}
+record_volume() { \
+    echo $AWS_BATCH_JOB_ID $1 > $slots/${devnode#/dev/}; \
+}
+# NOTE: a failed attach-volume leaves its slot claimed, so the next attempt moves on to the next free slot. A device
+# node that is already claimed but unused (reserved_devnode) is tried first.
+attach_volume() { \
+    for try in {1..3}; do \
+        if [[ -n $reserved_devnode ]]; then \
+            devnode=$reserved_devnode; \
+            reserved_devnode=; \
+        else \
+            allocate_devnode /dev/xvd{f..z}; \
+        fi; \
+        if aws ec2 attach-volume --instance-id $instance_id --volume-id $1 --device $devnode; then \
+            record_volume $1; \
+            return; \
+        fi; \
+    done; \
+    echo "Unable to attach $1" >&2; \
+    exit 1; \
+}
 
+# Volumes claimed from a storage pool are wiped and returned to it on exit, unless they had to be forcefully detached
 echo Setting up SIGEXIT handler >&2
 trap "cd / ; \
-      fuser %s >&2 || echo Fuser exit code \$? >&2; \
-      lsof %s | grep -iv lsof | awk '{print \$2}' | grep -v PID | xargs kill -9 || echo LSOF exit code \$? >&2; \
+      fuser %(mountpoint)s >&2 || echo Fuser exit code \$? >&2; \
+      lsof %(mountpoint)s | grep -iv lsof | awk '{print \$2}' | grep -v PID | xargs kill -9 || echo LSOF exit code \$? >&2; \
       sleep 3; \
-      umount %s || umount -l %s; \
-      aws ec2 detach-volume --volume-id $vid; \
-      let try=1; \
-      sleep 10; \
-      while ! aws ec2 describe-volumes --volume-ids $vid | jq -re .Volumes[0].Attachments==[]; do \
-          if [[ \$try -gt 2 ]]; then \
-              echo Forcefully detaching volume $vid >&2; \
-              aws ec2 detach-volume --force --volume-id $vid; \
-              sleep 10; \
-              echo Deleting volume $vid >&2; \
-              aws ec2 delete-volume --volume-id $vid; \
-              exit; \
+      if [[ -n \$pool ]] && mountpoint -q %(mountpoint)s; then \
+          echo Wiping volume \$vids >&2; \
+          find %(mountpoint)s -mindepth 1 -maxdepth 1 ! -name lost+found -exec rm -rf {} + || pool=; \
+      fi; \
+      umount %(mountpoint)s || umount -l %(mountpoint)s || echo Umount exit code \$? >&2; \
+      if [[ \$device == /dev/md* ]]; then \
+          mdadm --stop \$device || echo Mdadm exit code \$? >&2; \
+      fi; \
+      if [[ -n \$vids ]]; then \
+          for v in \$vids; do aws ec2 detach-volume --volume-id \$v || echo Detach exit code \$? >&2; done; \
+          if ! timeout 60 aws ec2 wait volume-available --volume-ids \$vids; then \
+              echo Forcefully detaching volumes \$vids >&2; \
+              for v in \$vids; do aws ec2 detach-volume --force --volume-id \$v || echo Detach exit code \$? >&2; done; \
+              timeout 60 aws ec2 wait volume-available --volume-ids \$vids || echo Wait exit code \$? >&2; \
+              pool=; \
           fi; \
-          sleep 10; \
-          let try=\$try+1; \
-      done; \
-      echo Deleting volume $vid >&2; \
-      aws ec2 delete-volume --volume-id $vid" EXIT
-
-echo Waiting for volume $vid to be created >&2
-while [[ $(aws ec2 describe-volumes --volume-ids $vid | jq -r .Volumes[0].State) != available ]]; do \
-    sleep 1; \
-done
+          if [[ -n \$pool ]]; then \
+              echo Returning volume \$vids to storage pool \$pool >&2; \
+          else \
+              echo Deleting volumes \$vids >&2; \
+              for v in \$vids; do aws ec2 delete-volume --volume-id \$v || echo Delete exit code \$? >&2; done; \
+          fi; \
+      fi; \
+      for s in \$claimed_slots; do rm -f \$s; done" EXIT
 
-# let each process start trying from a different /dev/xvd{letter}
-let pid=$$
-echo Finding unused devnode for volume $vid >&2
-# when N processes compete, for every success there can be N-1 failures; so the appropriate number of retries is O(N^2)
-# let us size this for 10 competitors
-# NOTE: the constants 9 and 10 in the $ind and $devnode calculation below are based on strlen("/dev/xvda")
-let delay=2+$pid%%5
-for try in {1..100}; do \
-    if [[ $try == 100 ]]; then \
-        echo "Unable to mount $vid on $devnode"; \
-        exit 1; \
+# A pool volume is claimed by attaching it: EC2 attaches a volume to at most one instance, so when jobs race for the
+# same volume, only one attach-volume call succeeds. Candidates are shuffled to spread concurrent jobs across them.
+if [[ -n $pool ]]; then \
+    echo Claiming a volume from storage pool $pool >&2; \
+    allocate_devnode /dev/xvd{f..z}; \
+    pool_filters="Name=tag:aegea_batch_storage_pool,Values=$pool Name=availability-zone,Values=$az Name=status,Values=available"; \
+    candidates=$(aws ec2 describe-volumes --filters $pool_filters | jq -r .Volumes[].VolumeId | shuf); \
+    for candidate in $candidates; do \
+        if aws ec2 attach-volume --instance-id $instance_id --volume-id $candidate --device $devnode; then \
+            record_volume $candidate; \
+            vids=$candidate; \
+            devnodes=$devnode; \
+            break; \
+        fi; \
+    done; \
+    if [[ -z $vids ]]; then \
+        reserved_devnode=$devnode; \
     fi; \
-    if [[ $try -gt 1 ]]; then \
-        sleep $delay; \
+    if [[ $(echo $candidates | wc -w) -le 1 ]]; then \
+        echo Topping up storage pool $pool in the background >&2; \
+        (aws ec2 create-volume --availability-zone $az %(create_volume_args)s \
+             --tag-specifications "ResourceType=volume,Tags=[{Key=aegea_batch_storage_pool,Value=$pool}]" > /dev/null &); \
     fi; \
-    devices=$(echo /dev/xvd* /dev/xvd{a..z} /dev/xvd{a..z} | sed 's= =\\n=g' | sort | uniq -c | sort -n | grep ' 2 ' | awk '{print $2}'); \
-    let devcnt=${#devices}/10+1; \
-    let ind=$pid%%devcnt; \
-    devnode=${devices:10*$ind:9}; \
-    aws ec2 attach-volume --instance-id $(echo "$iid" | jq -r .instanceId) --volume-id $vid --device $devnode || continue; \
-    break; \
-done
+fi
 
-# attach-volume is not instantaneous, and describe-volume requests are rate-limited
-echo Waiting for volume $vid to attach on $devnode >&2
-let delay=5+$pid%%11
-sleep $delay
-let try=1
-let max_tries=32
-while [[ $(aws ec2 describe-volumes --volume-ids $vid | jq -r .Volumes[0].State) != in-use ]]; do \
-    if [[ $try == $max_tries ]]; then \
-        break; \
+if [[ -z $vids ]]; then \
+    echo Creating $stripes volume\(s\) >&2; \
+    for i in $(seq $stripes); do \
+        vids="$vids $(aws ec2 create-volume --availability-zone $az %(create_volume_args)s | jq -r .VolumeId)"; \
+    done; \
+    if [[ -n $pool ]]; then \
+        aws ec2 create-tags --resources $vids --tags Key=aegea_batch_storage_pool,Value=$pool; \
     fi; \
-    let foo=1+$try%%5; \
-    let delay=2**$foo+$pid%%11; \
-    sleep $delay; \
+    echo Waiting for volumes $vids to be created >&2; \
+    aws ec2 wait volume-available --volume-ids $vids; \
+    for vid in $vids; do \
+        attach_volume $vid; \
+        devnodes="$devnodes $devnode"; \
+    done; \
+fi
+aws ec2 create-tags --resources $vids --tags Key=aegea_batch_job,Value=$AWS_BATCH_JOB_ID
+
+echo Waiting for volumes $vids to attach on $devnodes >&2
+for vid in $vids; do \
+    aws ec2 wait volume-in-use --volume-ids $vid --filters Name=attachment.status,Values=attached; \
 done
-while [[ ! -e $devnode ]]; do \
-    sleep 1; \
+for devnode in $devnodes; do \
+    while [[ ! -e $devnode ]]; do \
+        sleep 1; \
+    done; \
 done
 
-echo Making filesystem on $devnode >&2
-mkfs.ext4 $devnode
+# Striped volumes are assembled into a RAID0 array with 256 KiB chunks, and the filesystem is aligned to the chunks
+# (stride is the chunk size in 4 KiB filesystem blocks, and stripe_width is the stride times the number of stripes)
+mkfs_options=nodiscard
+if [[ $stripes -gt 1 ]]; then \
+    allocate_devnode /dev/md{0..127}; \
+    device=$devnode; \
+    echo Assembling RAID0 array $device from $devnodes >&2; \
+    mdadm --create $device --run --level=0 --chunk=256 --raid-devices=$stripes $devnodes; \
+    mkfs_options="$mkfs_options,stride=64,stripe_width=$((64 * stripes))"; \
+else \
+    device=${devnodes# }; \
+fi
+blockdev --setra %(readahead_sectors)s $device
+
+if blkid -t TYPE=ext4 $device > /dev/null; then \
+    echo Reusing filesystem on $device >&2; \
+else \
+    echo Making filesystem on $device >&2; \
+    mkfs.ext4 -m 0 -E $mkfs_options $device; \
+fi
+
+echo Mounting $device >& 2
+mount -o noatime $device %(mountpoint)s
 
-echo Mounting $devnode >& 2
-mount $devnode %s
+# Jobs that were killed before their exit handler ran return their volume to the pool without wiping it
+if [[ -n $pool ]]; then \
+    find %(mountpoint)s -mindepth 1 -maxdepth 1 ! -name lost+found -exec rm -rf {} +; \
+fi
 
-echo Devnode $devnode mounted >& 2
+echo Device $device mounted >& 2
 """ # noqa
 
 ebs_vol_mgr_shellcode = "\n".join(
@@ -215,6 +312,198 @@ def delete_compute_environment(args):
 parser = register_parser(delete_compute_environment, parent=batch_parser, help="Delete a Batch compute environment")
 parser.add_argument("name")
 
+# Instance families that the "optimal" instance type of Batch compute environments selects from
+optimal_instance_families = ["c4", "m4", "r4"]
+
+def get_instance_families(instance_types):
+    """
+    Return the instance types and families that a compute environment with the given instanceTypes can launch.
+    """
+    return [t for t in instance_types if t != "optimal"] + (optimal_instance_families if "optimal" in instance_types
+                                                            else [])
+
+def get_instance_type_catalog(instance_types):
+    """
+    Return a dict mapping the instance types (from the constants.json catalog) that a compute environment with the
+    given instanceTypes can launch to their vCPU count and memory in MiB. Instance types may be given as families.
+    """
+    families = get_instance_families(instance_types)
+    catalog = {}
+    for instance_type, instance_data in constants.get("instance_types").items():
+        if instance_type in families or instance_type.split(".")[0] in families:
+            catalog[instance_type] = (int(instance_data["vcpu"]), float(instance_data["memory"].rstrip(" GiB")) * 1024)
+    return catalog
+
+def get_container_resource(container, resource_type):
+    """
+    Return the VCPU or MEMORY requirement of a job container, which is given either as a top-level vcpus/memory field
+    or as an entry in resourceRequirements.
+    """
+    for requirement in container.get("resourceRequirements", []):
+        if requirement["type"] == resource_type:
+            return float(requirement["value"])
+    return container.get(dict(VCPU="vcpus", MEMORY="memory")[resource_type], 0)
+
+def get_queue_demand(job_queue, job_store):
+    """
+    Return the number of RUNNABLE and RUNNING jobs in a queue (counting each child of array jobs), their total vCPUs,
+    and the largest vCPU and memory requirements of any RUNNABLE job.
+    """
+    # Array parents can be listed under more than one status, but their children are counted once from statusSummary
+    job_ids = {job["jobId"] for job in list_all_jobs([job_queue], ["RUNNABLE", "RUNNING"])}
+    jobs = job_store.describe(sorted(job_ids))
+    demand = dict(RUNNABLE=0, RUNNING=0, vcpus=0, max_vcpus=0, max_memory=0)
+    for job in jobs:
+        counts = get_array_status_summary(job) or {job["status"]: 1}
+        for status in "RUNNABLE", "RUNNING":
+            demand[status] += counts.get(status, 0)
+            demand["vcpus"] += counts.get(status, 0) * get_container_resource(job["container"], "VCPU")
+        if counts.get("RUNNABLE"):
+            demand["max_vcpus"] = max(demand["max_vcpus"], get_container_resource(job["container"], "VCPU"))
+            demand["max_memory"] = max(demand["max_memory"], get_container_resource(job["container"], "MEMORY"))
+    return demand
+
+def advise(args):
+    job_queue = clients.batch.describe_job_queues(jobQueues=[args.queue])["jobQueues"][0]
+    ce_order = sorted(job_queue["computeEnvironmentOrder"], key=lambda ce: ce["order"])
+    ce_names = [ce["computeEnvironment"] for ce in ce_order]
+    ces = clients.batch.describe_compute_environments(computeEnvironments=ce_names)["computeEnvironments"]
+    managed_ces = [ce for ce in ces if ce["type"] == "MANAGED"]
+    if not managed_ces:
+        raise AegeaException("Job queue {} has no managed compute environment to advise on".format(args.queue))
+    ce = managed_ces[0]
+    job_store, demand = JobStore(), None
+    for i in range(args.samples):
+        if i > 0:
+            time.sleep(args.interval)
+        sample = get_queue_demand(args.queue, job_store)
+        demand = sample if demand is None else {k: max(v, sample[k]) for k, v in demand.items()}
+    logger.info("Demand on %s: %d RUNNABLE and %d RUNNING jobs requesting %d vCPUs", args.queue, demand["RUNNABLE"],
+                demand["RUNNING"], demand["vcpus"])
+    compute_resources, recommendations = ce["computeResources"], []
+
+    def recommend(parameter, value, reason):
+        if value != compute_resources.get(parameter):
+            recommendations.append([ce["computeEnvironmentName"], parameter, compute_resources.get(parameter), value,
+                                    reason])
+
+    catalog = get_instance_type_catalog(compute_resources["instanceTypes"])
+    # Instance sizes are needed to round maxvCpus up to whole instances and to check that waiting jobs fit, so those
+    # recommendations are skipped rather than guessed when the catalog doesn't cover the instance types
+    unknown_types = [t for t in get_instance_families(compute_resources["instanceTypes"])
+                     if not any(t in (known_type, known_type.split(".")[0]) for known_type in catalog)]
+    largest_instance_vcpus = max([vcpus for vcpus, memory in catalog.values()] or [0])
+    needed_vcpus = int(math.ceil(demand["vcpus"] * args.headroom))
+    min_vcpus = min(compute_resources["minvCpus"], int(math.ceil(demand["vcpus"])))
+    max_vcpus = compute_resources["maxvCpus"]
+    recommend("minvCpus", min_vcpus, "minvCpus is above demand and pays for idle instances")
+    if unknown_types:
+        logger.warn("Instance types %s are not in the instance type catalog; skipping maxvCpus and instanceTypes "
+                    "recommendations", ", ".join(unknown_types))
+    elif demand["RUNNABLE"] and max_vcpus < needed_vcpus:
+        # Leave room for one more of the largest instances, since Batch rounds capacity up to whole instances
+        max_vcpus = needed_vcpus + largest_instance_vcpus
+        recommend("maxvCpus", max_vcpus, "jobs are waiting and maxvCpus is below demand")
+    elif not demand["RUNNABLE"] and max_vcpus > max(needed_vcpus, 1) * args.idle_factor:
+        max_vcpus = max(needed_vcpus + largest_instance_vcpus, min_vcpus)
+        recommend("maxvCpus", max_vcpus, "maxvCpus is more than {}x demand".format(args.idle_factor))
+    if demand["RUNNABLE"] and compute_resources["desiredvCpus"] < min(needed_vcpus, max_vcpus):
+        recommend("desiredvCpus", min(needed_vcpus, max_vcpus), "scale up now for waiting jobs")
+    elif not min_vcpus <= compute_resources["desiredvCpus"] <= max_vcpus:
+        recommend("desiredvCpus", max(min_vcpus, min(compute_resources["desiredvCpus"], max_vcpus)),
+                  "desiredvCpus must be between minvCpus and maxvCpus")
+    fitting_types = [t for t, (vcpus, memory) in catalog.items()
+                     if vcpus >= demand["max_vcpus"] and memory >= demand["max_memory"]]
+    if demand["RUNNABLE"] and not fitting_types and not unknown_types:
+        memory_per_vcpu = demand["max_memory"] / max(demand["max_vcpus"], 1)
+        family = "c4" if memory_per_vcpu <= 2048 else "m4" if memory_per_vcpu <= 4096 else "r4"
+        candidates = get_instance_type_catalog([family])
+        fitting_types = sorted((t for t, (vcpus, memory) in candidates.items()
+                                if vcpus >= demand["max_vcpus"] and memory >= demand["max_memory"]),
+                               key=lambda t: candidates[t])
+        reason = "no instance type can run the largest waiting job ({max_vcpus} vCPUs, {max_memory} MiB)"
+        recommend("instanceTypes", compute_resources["instanceTypes"] + fitting_types[:1], reason.format(**demand))
+    if args.apply:
+        updates = {parameter: value for _, parameter, _, value, _ in recommendations if parameter != "instanceTypes"}
+        if updates:
+            logger.info("Updating %s: %s", ce["computeEnvironmentName"], updates)
+            clients.batch.update_compute_environment(computeEnvironment=ce["computeEnvironmentName"],
+                                                     computeResources=updates)
+        if "instanceTypes" in [r[1] for r in recommendations]:
+            logger.warn("Instance types of a compute environment can't be updated; create a new one to change them")
+    page_output(format_table(recommendations,
+                             column_names=["Compute environment", "Parameter", "Current", "Recommended", "Reason"],
+                             max_col_width=args.max_col_width))
+
+parser = register_parser(advise, parent=batch_parser, help="Recommend compute environment vCPU limits for a queue",
+                         description="""Compare the vCPUs requested by RUNNABLE and RUNNING jobs in a queue with the
+minvCpus, desiredvCpus, maxvCpus and instance types of its first managed compute environment, and recommend changes""")
+parser.add_argument("queue")
+parser.add_argument("--samples", type=int, default=1, help="Sample the queue this many times, and use the peak demand")
+parser.add_argument("--interval", type=float, default=30, help="Seconds between samples")
+parser.add_argument("--headroom", type=float, default=1.2, help="Recommend maxvCpus this many times the demand")
+parser.add_argument("--idle-factor", type=float, default=4,
+                    help="Recommend lowering maxvCpus when it is more than this many times the demand")
+parser.add_argument("--apply", action="store_true", help="Update the compute environment with the recommendations")
+
+def get_storage_pool_name(size_gb, volume_type="st1", iops=None, throughput=None):
+    name = "{}-{}".format(volume_type, int(size_gb))
+    if iops:
+        name += "-{}iops".format(iops)
+    if throughput:
+        name += "-{}mbps".format(throughput)
+    return name
+
+def storage_pool(args):
+    """
+    If args.count is given, top up the pool of available volumes in each availability zone to it, or delete available
+    volumes in excess of it. Volumes in use by jobs are neither counted nor deleted. Then list the volumes in the pool.
+    """
+    if args.volume_type in {"io1", "io2"} and args.iops is None:
+        raise AegeaException("{} volumes require --iops".format(args.volume_type))
+    if args.volume_type in {"st1", "sc1"} and int(args.size_gb) < 125:
+        raise AegeaException("{} volumes must be at least 125 GB".format(args.volume_type))
+    pool = get_storage_pool_name(args.size_gb, args.volume_type, iops=args.iops, throughput=args.throughput)
+    create_volume_args = dict(Size=int(args.size_gb), VolumeType=args.volume_type)
+    if args.iops:
+        create_volume_args.update(Iops=args.iops)
+    if args.throughput:
+        create_volume_args.update(Throughput=args.throughput)
+    tag_spec = dict(ResourceType="volume", Tags=[dict(Key="aegea_batch_storage_pool", Value=pool)])
+    for az in (args.availability_zones or availability_zones()) if args.count is not None else []:
+        filters = [dict(Name="tag:aegea_batch_storage_pool", Values=[pool]),
+                   dict(Name="availability-zone", Values=[az]),
+                   dict(Name="status", Values=["available", "creating"])]
+        volumes = list(paginate(clients.ec2.get_paginator("describe_volumes"), Filters=filters))
+        for _ in range(args.count - len(volumes)):
+            volume = clients.ec2.create_volume(AvailabilityZone=az, TagSpecifications=[tag_spec], **create_volume_args)
+            logger.info("Created %s in %s", volume["VolumeId"], az)
+        # Volumes that are still being created count toward the pool, but only available volumes can be deleted
+        available_volumes = [volume for volume in volumes if volume["State"] == "available"]
+        for volume in available_volumes[:max(len(volumes) - args.count, 0)]:
+            clients.ec2.delete_volume(VolumeId=volume["VolumeId"])
+            logger.info("Deleted %s in %s", volume["VolumeId"], az)
+    volumes = paginate(clients.ec2.get_paginator("describe_volumes"),
+                       Filters=[dict(Name="tag:aegea_batch_storage_pool", Values=[pool])])
+    table = [dict(volume, Job={tag["Key"]: tag["Value"] for tag in volume.get("Tags", [])}.get("aegea_batch_job"))
+             for volume in volumes]
+    cell_transforms = {"Attachments": lambda attachments, row: ", ".join(a["InstanceId"] for a in attachments)}
+    page_output(tabulate(table, args, cell_transforms=cell_transforms))
+
+parser = register_parser(storage_pool, parent=batch_parser, help="Manage a warm pool of EBS volumes for --storage",
+                         description="""Jobs submitted with --storage MOUNTPOINT=SIZE_GB --storage-pool claim an
+available volume of that size, type, IOPS and throughput from the pool in their availability zone instead of creating
+one, reuse its filesystem, and wipe and return it to the pool when they exit. A volume is formatted by the first job
+that uses it.""")
+parser.add_argument("size_gb", metavar="SIZE_GB")
+parser.add_argument("--count", type=int, help="Number of available volumes to keep in each availability zone")
+parser.add_argument("--volume-type", default="st1", help="EBS volume type of the volumes in the pool")
+parser.add_argument("--iops", type=int, help="Provisioned IOPS of the volumes in the pool (required for io1 and io2)")
+parser.add_argument("--throughput", type=int, help="Provisioned throughput of the volumes in the pool, in MiB/s (gp3)")
+parser.add_argument("--availability-zones", nargs="+", help="Availability zones to manage (default: all)")
+parser.add_argument("--columns", nargs="+", default=["VolumeId", "AvailabilityZone", "Size", "State", "Attachments",
+                                                     "Job", "CreateTime"])
+
 def get_ecr_image_uri(tag):
     return "{}.dkr.ecr.{}.amazonaws.com/{}".format(ARN.get_account_id(), ARN.get_region(), tag)
 
@@ -235,7 +524,66 @@ def ensure_dynamodb_table(name, hash_key_name, read_capacity_units=5, write_capa
     table.wait_until_exists()
     return table
 
-def get_command_and_env(args):
+def parse_storage_spec(spec):
+    """
+    Parse a --storage value of the form MOUNTPOINT=SIZE_GB[,type=VOLUME_TYPE,iops=IOPS,throughput=MBPS,stripes=N].
+    """
+    try:
+        mountpoint, options = spec.split("=", 1)
+        size_gb, options = (options.split(",", 1) + [""])[:2]
+        storage = dict(mountpoint=mountpoint, size_gb=int(size_gb.rstrip("GBgb")), type="st1", iops=None,
+                       throughput=None, stripes=1)
+        for option in filter(None, options.split(",")):
+            key, value = option.split("=", 1)
+            if key not in {"type", "iops", "throughput", "stripes"}:
+                raise ValueError(key)
+            storage[key] = value if key == "type" else int(value)
+        for key in "size_gb", "iops", "throughput", "stripes":
+            if storage[key] is not None and storage[key] < 1:
+                raise ValueError(key)
+    except ValueError:
+        msg = 'Expected MOUNTPOINT=SIZE_GB[,type=VOLUME_TYPE,iops=IOPS,throughput=MBPS,stripes=N], got "{}"'
+        raise argparse.ArgumentTypeError(msg.format(spec))
+    if storage["type"] in {"io1", "io2"} and storage["iops"] is None:
+        raise argparse.ArgumentTypeError('{} volumes require iops=IOPS, got "{}"'.format(storage["type"], spec))
+    if storage["type"] in {"st1", "sc1"} and get_stripe_size_gb(storage) < 125:
+        msg = '{} volumes must be at least 125 GB (per stripe), got "{}"'
+        raise argparse.ArgumentTypeError(msg.format(storage["type"], spec))
+    return storage
+
+def get_stripe_size_gb(storage):
+    return int(math.ceil(storage["size_gb"] / storage["stripes"]))
+
+def get_ebs_vol_mgr_shellcode(storage, use_storage_pool=False):
+    """
+    Return commands that create the EBS volumes for a --storage value (or claim one from the storage pool), attach
+    them, assemble them into a RAID0 array if there is more than one stripe, and mount the filesystem on them. The size
+    of the storage is split evenly across the stripes, and the IOPS and throughput are provisioned for each stripe.
+    """
+    if use_storage_pool and storage["stripes"] > 1:
+        raise AegeaException("Striped --storage volumes can't be claimed from a storage pool")
+    volume_size_gb = get_stripe_size_gb(storage)
+    create_volume_args = "--size {} --volume-type {}".format(volume_size_gb, storage["type"])
+    for option in "iops", "throughput":
+        if storage[option]:
+            create_volume_args += " --{} {}".format(option, storage[option])
+    # Throughput-optimized HDD volumes benefit from a large readahead (1 MiB per stripe); the default (128 KiB) is kept
+    # for SSD volumes, where I/O is more often random
+    readahead_kb = (1024 if storage["type"] in {"st1", "sc1"} else 128) * storage["stripes"]
+    storage_pool = ""
+    if use_storage_pool:
+        storage_pool = get_storage_pool_name(volume_size_gb, storage["type"], iops=storage["iops"],
+                                             throughput=storage["throughput"])
+    return (ebs_vol_mgr_shellcode % dict(mountpoint=storage["mountpoint"], create_volume_args=create_volume_args,
+                                         stripes=storage["stripes"], storage_pool=storage_pool,
+                                         packages=" mdadm" if storage["stripes"] > 1 else "",
+                                         readahead_sectors=readahead_kb * 2)).splitlines()
+
+def get_command_prelude_and_env(args):
+    """
+    Return the commands that set up the job environment, storage and payload (but not the job command itself), and the
+    job environment variables.
+    """
     # shellcode = ['for var in ${{!AWS_BATCH_@}}; do echo "{}.env.$var=${{!var}}"; done'.format(__name__)]
     shellcode = ["set -a",
                  "if [ -f /etc/environment ]; then source /etc/environment; fi",
@@ -246,8 +594,8 @@ def get_command_and_env(args):
     if args.storage:
         args.privileged = True
         args.volumes.append(["/dev", "/dev"])
-        for mountpoint, size_gb in args.storage:
-            shellcode += (ebs_vol_mgr_shellcode % tuple([size_gb] + [mountpoint] * 5)).splitlines()
+        for storage in args.storage:
+            shellcode += get_ebs_vol_mgr_shellcode(storage, use_storage_pool=args.storage_pool)
     elif args.efs_storage:
         args.privileged = True
         if "=" in args.efs_storage:
@@ -263,15 +611,13 @@ def get_command_and_env(args):
                 raise AegeaException('Could not resolve "{}" to a valid EFS filesystem ID'.format(efs_id))
         mount_targets = clients.efs.describe_mount_targets(FileSystemId=efs_id)["MountTargets"]
         args.environment.append(dict(name="AEGEA_EFS_DESC", value=json.dumps(mount_targets)))
-        commands = efs_vol_shellcode.format(efs_mountpoint=args.efs_storage, efs_id=efs_id).splitlines()
+        commands = efs_vol_shellcode.format(efs_mountpoint=mountpoint, efs_id=efs_id).splitlines()
         shellcode += commands
 
     if args.execute:
         bucket = ensure_s3_bucket("aegea-batch-jobs-{}".format(ARN.get_account_id()))
-
-        key_name = hashlib.sha256(args.execute.read()).hexdigest()
-        args.execute.seek(0)
-        bucket.upload_fileobj(args.execute, key_name)
+        with EnsuredResources.verify_on_error():
+            key_name = upload_content_addressed(args.execute, bucket)
         payload_url = clients.s3.generate_presigned_url(
             ClientMethod='get_object',
             Params=dict(Bucket=bucket.name, Key=key_name),
@@ -311,10 +657,19 @@ def get_command_and_env(args):
             # "pip install ruamel.yaml==0.13.4 cwltool==1.0.20161227200419 dynamoq tractorbeam",
             "cwltool --no-container --preserve-entire-environment <(echo $AEGEA_BATCH_CWL_DEF_B64 | base64 -d) <(echo $AEGEA_BATCH_CWL_JOB_B64 | base64 -d | tractor pull) | tractor push $AEGEA_BATCH_S3_BASE_URL/$AWS_BATCH_JOB_ID | dynamoq update aegea-batch-jobs $AWS_BATCH_JOB_ID" # noqa
         ]
-    args.command = bash_cmd_preamble + shellcode + (args.command or [])
-    return args.command, args.environment
+    return bash_cmd_preamble + shellcode, args.environment
 
-def ensure_job_definition(args):
+def get_command_and_env(args):
+    command_prelude, environment = get_command_prelude_and_env(args)
+    return command_prelude + (args.command or []), environment
+
+@lru_cache()
+def get_job_role_arn(job_role):
+    iam_role = ensure_iam_role(job_role, trust=["ecs-tasks"],
+                               policies=["AmazonEC2FullAccess", "AmazonDynamoDBFullAccess", "AmazonS3FullAccess"])
+    return iam_role.arn
+
+def get_container_properties(args):
     if args.ecs_image:
         args.image = get_ecr_image_uri(args.ecs_image)
     container_props = {k: getattr(args, k) for k in ("image", "vcpus", "memory", "privileged")}
@@ -323,18 +678,42 @@ def ensure_job_definition(args):
         for i, (host_path, guest_path) in enumerate(args.volumes):
             container_props["volumes"].append({"host": {"sourcePath": host_path}, "name": "vol%d" % i})
             container_props["mountPoints"].append({"sourceVolume": "vol%d" % i, "containerPath": guest_path})
-    iam_role = ensure_iam_role(args.job_role, trust=["ecs-tasks"],
-                               policies=["AmazonEC2FullAccess", "AmazonDynamoDBFullAccess", "AmazonS3FullAccess"])
     if args.ulimits:
         container_props.setdefault("ulimits", [])
         for ulimit in args.ulimits:
             name, value = ulimit.split(":", 1)
             container_props["ulimits"].append(dict(name=name, hardLimit=int(value), softLimit=int(value)))
-    container_props.update(jobRoleArn=iam_role.arn)
-    return clients.batch.register_job_definition(jobDefinitionName=__name__.replace(".", "_"),
-                                                 type="container",
-                                                 containerProperties=container_props,
-                                                 retryStrategy=dict(attempts=args.retry_attempts))
+    container_props.update(jobRoleArn=get_job_role_arn(args.job_role))
+    return container_props
+
+job_definitions, job_definitions_lock = {}, threading.Lock()
+
+def ensure_job_definition(args):
+    """
+    Return a job definition with the container properties and retry strategy given by args. Job definitions are
+    registered with a hash of these in their parameters, so that an existing active revision with the same hash is
+    reused instead of registering a new one. Results are also memoized for the lifetime of the process.
+    """
+    jd_name = __name__.replace(".", "_")
+    jd_args = dict(type="container", containerProperties=get_container_properties(args),
+                   retryStrategy=dict(attempts=args.retry_attempts))
+    jd_hash = hashlib.sha256(json.dumps(jd_args, sort_keys=True).encode()).hexdigest()
+    with job_definitions_lock:
+        if jd_hash not in job_definitions:
+            for jd in paginate(clients.batch.get_paginator("describe_job_definitions"), jobDefinitionName=jd_name,
+                               status="ACTIVE"):
+                if jd.get("parameters", {}).get("aegea_job_definition_hash") == jd_hash:
+                    job_definitions[jd_hash] = jd
+                    break
+            else:
+                with EnsuredResources.verify_on_error():
+                    job_definitions[jd_hash] = clients.batch.register_job_definition(
+                        jobDefinitionName=jd_name, parameters=dict(aegea_job_definition_hash=jd_hash), **jd_args
+                    )
+        return job_definitions[jd_hash]
+
+# Serializes creation of missing queues by jobs that are submitted concurrently
+queues_lock = threading.Lock()
 
 def ensure_queue(name):
     cq_args = argparse.Namespace(name=name, priority=5, compute_environments=[name])
@@ -344,29 +723,129 @@ def ensure_queue(name):
         create_compute_environment(cce_parser.parse_args(args=[name]))
         return create_queue(cq_args)
 
-def submit(args):
-    ensure_log_group("docker")
-    ensure_log_group("syslog")
-    command, environment = get_command_and_env(args)
+# Options that can be set per job in a manifest; other manifest fields are passed to the job as environment variables
+manifest_options = {"name", "queue", "depends_on", "command", "environment", "parameters", "image", "ecs_image",
+                    "vcpus", "memory_mb", "privileged", "volumes", "ulimits", "job_role", "retry_attempts",
+                    "array_size"}
+
+def read_manifest(manifest):
+    if manifest.name.endswith(".csv"):
+        return list(csv.DictReader(manifest))
+    return [json.loads(line) for line in manifest if line.strip()]
+
+def get_manifest_job_args(args, manifest_entry):
+    job_args = copy.copy(args)
+    job_args.environment, job_args.parameters = list(args.environment), list(args.parameters)
+    for key, value in manifest_entry.items():
+        # CSV manifests can't leave a column out of a row, so empty values are treated as unset
+        if value is None or value == "":
+            continue
+        if key.replace("-", "_") not in manifest_options:
+            job_args.environment.append(dict(name=key, value=str(value)))
+            continue
+        action = submit_parser._option_string_actions["--" + key.replace("_", "-")]
+        if isinstance(value, dict):
+            value = ["{}={}".format(k, v) for k, v in value.items()]
+        elif action.nargs in ("+", "*") and not isinstance(value, list):
+            value = [value] if action.dest == "command" else value.split()
+        if action.type is not None and isinstance(value, list):
+            value = [action.type(v) for v in value]
+        elif action.type is not None:
+            value = action.type(value)
+        elif action.const is True and not isinstance(value, bool):
+            value = value.lower() in {"true", "yes", "1"}
+        if action.dest in {"environment", "parameters"}:
+            value = getattr(job_args, action.dest) + value
+        setattr(job_args, action.dest, value)
+    return job_args
+
+def submit_from_manifest(args):
+    """
+    Submit one job per entry in a JSON lines or CSV manifest, concurrently and at no more than args.submit_rate jobs
+    per second. The job command prelude and environment are set up once for all jobs, and jobs with identical
+    container properties share a job definition.
+    """
+    manifest, job_command = read_manifest(args.from_manifest), args.command or []
+    command_prelude, environment = get_command_prelude_and_env(args)
+    rate_limiter = RateLimiter(args.submit_rate)
+
+    def submit_manifest_job(i, manifest_entry):
+        job_name = manifest_entry.get("name") or None
+        try:
+            job_args = get_manifest_job_args(args, manifest_entry)
+            job_args.command = command_prelude + (job_args.command or job_command)
+            if job_args.name is None and job_args.job_definition_arn is None:
+                jd = ensure_job_definition(job_args)
+                job_args.name = "{}_{}_{}".format(jd["jobDefinitionName"], jd["revision"], i)
+            elif job_args.name is None:
+                jd_name = ARN(job_args.job_definition_arn).resource.split("/")[-1]
+                job_args.name = "{}_{}".format(jd_name.replace(":", "_"), i)
+            job_name = job_args.name
+            rate_limiter.wait()
+            return submit_job(job_args, job_args.command, job_args.environment)
+        except Exception as e:
+            logger.error("Error submitting job %d (%s): %s", i, job_name, e)
+            return dict(jobName=job_name, error=str(e))
+
+    with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+        jobs = list(executor.map(submit_manifest_job, range(len(manifest)), manifest))
+    logger.info("Submitted %d of %d jobs", len([job for job in jobs if "jobId" in job]), len(jobs))
+    return jobs
+
+def get_array_index_shellcode(environment):
+    """
+    Return commands that substitute the array index of the job for {array_index} in the values of environment
+    variables. Without an array index (when the job is not part of an array job), 0 is substituted.
+    """
+    return ['export {name}="${{{name}//"{{array_index}}"/${{AWS_BATCH_JOB_ARRAY_INDEX:-0}}}}"'.format(name=var["name"])
+            for var in environment if "{array_index}" in var["value"]]
+
+def submit_job(args, command, environment):
     if args.job_definition_arn is None:
         jd_res = ensure_job_definition(args)
-        args.job_definition_arn = jd_res["jobDefinitionArn"]
-        args.name = "{}_{}".format(jd_res["jobDefinitionName"], jd_res["revision"])
+        job_definition_arn = jd_res["jobDefinitionArn"]
+        args.name = args.name or "{}_{}".format(jd_res["jobDefinitionName"], jd_res["revision"])
+    else:
+        job_definition_arn = args.job_definition_arn
     submit_args = dict(jobName=args.name,
                        jobQueue=args.queue,
                        dependsOn=[dict(jobId=dep) for dep in args.depends_on],
-                       jobDefinition=args.job_definition_arn,
+                       jobDefinition=job_definition_arn,
                        parameters={k: v for k, v in args.parameters},
                        containerOverrides=dict(command=command, environment=environment))
+    array_index_shellcode = get_array_index_shellcode(environment)
+    if array_index_shellcode and command[:len(bash_cmd_preamble)] == bash_cmd_preamble:
+        command = bash_cmd_preamble + array_index_shellcode + command[len(bash_cmd_preamble):]
+        submit_args["containerOverrides"].update(command=command)
+    if args.array_size:
+        submit_args.update(arrayProperties=dict(size=args.array_size))
     if args.dry_run:
         return {"Dry run succeeded": True}
-    try:
-        job = clients.batch.submit_job(**submit_args)
-    except ClientError as e:
-        if not re.search("JobQueue .+ not found", str(e)):
-            raise
-        ensure_queue(args.queue)
-        job = clients.batch.submit_job(**submit_args)
+    with EnsuredResources.verify_on_error():
+        try:
+            job = clients.batch.submit_job(**submit_args)
+        except ClientError as e:
+            if not re.search("JobQueue .+ not found", str(e)):
+                raise
+            with queues_lock:
+                ensure_queue(args.queue)
+            job = clients.batch.submit_job(**submit_args)
+    return job
+
+@reverify_ensured_resources_on_error
+def submit(args):
+    # The role is looked up once per submit command, and again if the command is retried with re-verified resources
+    get_job_role_arn.cache_clear()
+    ensure_log_group("docker")
+    ensure_log_group("syslog")
+    if args.from_manifest:
+        return submit_from_manifest(args)
+    if not (args.command or args.execute or args.cwl):
+        raise AegeaException("One of --command, --execute, --cwl or --from-manifest is required")
+    command, environment = get_command_and_env(args)
+    job = submit_job(args, command, environment)
+    if args.dry_run:
+        return job
     if args.watch:
         watch(watch_parser.parse_args([job["jobId"]]))
         if args.cwl:
@@ -380,10 +859,13 @@ submit_parser.add_argument("--name")
 submit_parser.add_argument("--queue", default=__name__.replace(".", "_"))
 submit_parser.add_argument("--depends-on", nargs="+", metavar="JOB_ID", default=[])
 submit_parser.add_argument("--job-definition-arn")
+submit_parser.add_argument("--array-size", type=int, metavar="N",
+                           help="""Submit an array job of N child jobs. Each child job can read its index (0 to N-1)
+from $AWS_BATCH_JOB_ARRAY_INDEX, and {array_index} in values given to --environment is replaced with it.""")
 group = submit_parser.add_mutually_exclusive_group()
 group.add_argument("--watch", action="store_true", help="Monitor submitted job, stream log until job completes")
 group.add_argument("--wait", action="store_true", help="Block on job. Exit with code 0 if job succeeded, 1 if failed")
-group = submit_parser.add_mutually_exclusive_group(required=True)
+group = submit_parser.add_mutually_exclusive_group()
 group.add_argument("--command", nargs="+", help="Run these commands as the job (using " + BOLD("bash -c") + ")")
 group.add_argument("--execute", type=argparse.FileType("rb"), metavar="EXECUTABLE",
                    help="Read this executable file and run it as the job")
@@ -410,8 +892,12 @@ group.add_argument("--environment", nargs="+", metavar="NAME=VALUE",
 group.add_argument("--parameters", nargs="+", metavar="NAME=VALUE", type=lambda x: x.split("=", 1), default=[])
 group.add_argument("--job-role", metavar="IAM_ROLE", default=__name__ + ".worker",
                    help="Name of IAM role to grant to the job")
-group.add_argument("--storage", nargs="+", metavar="MOUNTPOINT=SIZE_GB",
-                   type=lambda x: x.rstrip("GBgb").split("=", 1), default=[])
+group.add_argument("--storage", nargs="+", metavar="MOUNTPOINT=SIZE_GB[,type=TYPE,iops=N,throughput=N,stripes=N]",
+                   type=parse_storage_spec, default=[],
+                   help="""Create EBS volumes of the given total size and type (default: st1) for the job, stripe them
+                   with RAID0 if there is more than one stripe, and mount them at MOUNTPOINT""")
+group.add_argument("--storage-pool", action="store_true",
+                   help="Claim --storage volumes from a warm pool of formatted volumes (see aegea batch storage-pool)")
 group.add_argument("--efs-storage", action="store", dest="efs_storage", default=False,
                    help="mount nfs drive to the mount point specified. i.e. --efs-storage /mnt")
 submit_parser.add_argument("--timeout",
@@ -419,6 +905,125 @@ submit_parser.add_argument("--timeout",
 submit_parser.add_argument("--retry-attempts", type=int, default=1,
                            help="Number of times to restart the job upon failure")
 submit_parser.add_argument("--dry-run", action="store_true", help="Gather arguments and stop short of submitting job")
+group = submit_parser.add_argument_group(title="bulk submission")
+group.add_argument("--from-manifest", type=argparse.FileType("r"), metavar="MANIFEST",
+                   help="""Submit one job per line of this JSON lines file, or per row of this CSV file (*.csv).
+Fields named after options ({}) override those options for the job; other fields are passed to the job as
+environment variables. The --command, --execute or --cwl given on the command line is the default command.""".format(
+                       ", ".join(sorted(manifest_options))))
+group.add_argument("--submit-rate", type=float, default=10,
+                   help="With --from-manifest, submit at most this many jobs per second")
+group.add_argument("--max-concurrency", type=int, default=16,
+                   help="With --from-manifest, submit at most this many jobs at once")
+
+# Batch accepts at most this many dependencies per job
+max_job_dependencies = 20
+
+def get_workflow_layers(workflow_jobs):
+    """
+    Sort the jobs of a workflow into layers, given a dict mapping job names to the names of the jobs they depend on.
+    Each layer contains the jobs whose dependencies are all in earlier layers (Kahn's algorithm).
+    """
+    for name, dependencies in workflow_jobs.items():
+        for dependency in dependencies:
+            if dependency not in workflow_jobs:
+                raise AegeaException('Job "{}" depends on unknown job "{}"'.format(name, dependency))
+    num_dependencies = {name: len(set(dependencies)) for name, dependencies in workflow_jobs.items()}
+    dependents = collections.defaultdict(list)
+    for name, dependencies in workflow_jobs.items():
+        for dependency in set(dependencies):
+            dependents[dependency].append(name)
+    layers, layer = [], sorted(name for name, n in num_dependencies.items() if n == 0)
+    while layer:
+        layers.append(layer)
+        next_layer = []
+        for name in layer:
+            for dependent in dependents[name]:
+                num_dependencies[dependent] -= 1
+                if num_dependencies[dependent] == 0:
+                    next_layer.append(dependent)
+        layer = sorted(next_layer)
+    if sum(len(layer) for layer in layers) < len(workflow_jobs):
+        cycle = sorted(name for name, n in num_dependencies.items() if n > 0)
+        raise AegeaException("Workflow dependencies contain a cycle among jobs {}".format(", ".join(cycle)))
+    return layers
+
+def reduce_dependencies(depends_on, submit_barrier):
+    """
+    Return at most max_job_dependencies job IDs that together stand for the jobs in depends_on. Larger lists are split
+    into chunks, each of which is replaced by a barrier job that depends on it: submit_barrier is called with each chunk
+    and returns the ID of the barrier job. This repeats until few enough barrier jobs are left.
+    """
+    while len(depends_on) > max_job_dependencies:
+        depends_on = [submit_barrier(chunk) for chunk in chunked(depends_on, max_job_dependencies)]
+    return depends_on
+
+def read_workflow(workflow_file):
+    workflow = yaml.safe_load(workflow_file)
+    workflow_jobs = collections.OrderedDict()
+    for name, job in (workflow.get("jobs") or {}).items():
+        job = dict(job or {})
+        depends_on = job.pop("depends_on", [])
+        workflow_jobs[name] = dict(job, name=job.get("name", name),
+                                   depends_on=[depends_on] if isinstance(depends_on, str) else list(depends_on))
+    for edge in workflow.get("edges", []):
+        from_job, to_job = edge if isinstance(edge, (list, tuple)) else edge.split("->")
+        if to_job.strip() not in workflow_jobs:
+            raise AegeaException('Edge "{}" refers to unknown job "{}"'.format(edge, to_job.strip()))
+        workflow_jobs[to_job.strip()]["depends_on"].append(from_job.strip())
+    return workflow.get("defaults") or {}, workflow_jobs
+
+def submit_dag(args):
+    """
+    Submit the jobs of a workflow layer by layer, in topological order, so that the IDs of the jobs each job depends on
+    are known when it is submitted. The jobs in each layer are submitted concurrently. Jobs with more than 20
+    dependencies depend instead on barrier jobs that each depend on up to 20 of them.
+    """
+    ensure_log_group("docker")
+    ensure_log_group("syslog")
+    get_job_role_arn.cache_clear()
+    defaults, workflow_jobs = read_workflow(args.workflow)
+    layers = get_workflow_layers({name: job["depends_on"] for name, job in workflow_jobs.items()})
+    base_args = argparse.Namespace(**{a.dest: submit_parser.get_default(a.dest)
+                                      for a in submit_parser._actions if a.dest != "help"})
+    base_args.environment, base_args.volumes = [], []
+    base_args.queue, base_args.dry_run = args.queue or base_args.queue, args.dry_run
+    base_args = get_manifest_job_args(base_args, defaults)
+    job_command = base_args.command or []
+    command_prelude, environment = get_command_prelude_and_env(base_args)
+    rate_limiter, job_ids, submitted_jobs = RateLimiter(args.submit_rate), {}, []
+
+    def submit_workflow_job(job_args, command, depends_on):
+        barrier_args = get_manifest_job_args(base_args, dict(name=job_args.name + "_barrier", environment={}))
+        depends_on = reduce_dependencies(depends_on, lambda chunk: submit_workflow_job(barrier_args, ["true"], chunk))
+        job_args = copy.copy(job_args)
+        job_args.depends_on = depends_on
+        rate_limiter.wait()
+        job = dict(submit_job(job_args, command, job_args.environment), jobName=job_args.name, dependsOn=depends_on)
+        submitted_jobs.append(job)
+        return job.get("jobId", job_args.name)
+
+    def submit_layer_job(name):
+        job = dict(workflow_jobs[name])
+        depends_on = [job_ids[dependency] for dependency in job.pop("depends_on")]
+        job_args = get_manifest_job_args(base_args, job)
+        return submit_workflow_job(job_args, command_prelude + (job_args.command or job_command), depends_on)
+
+    with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+        for i, layer in enumerate(layers):
+            logger.info("Submitting %d job(s) in layer %d of %d", len(layer), i + 1, len(layers))
+            job_ids.update(zip(layer, executor.map(submit_layer_job, layer)))
+    return submitted_jobs
+
+parser = register_parser(submit_dag, parent=batch_parser, help="Submit a workflow of interdependent Batch jobs")
+parser.add_argument("workflow", type=argparse.FileType("r"), help="""YAML file describing the workflow. Its "jobs" key
+maps job names to the submit options of each job, as in a --from-manifest manifest, and "depends_on", a list of names of
+jobs the job depends on. Dependencies may also be listed as "edges", pairs of job names (or strings "a -> b"). Options
+under the "defaults" key apply to all jobs.""")
+parser.add_argument("--queue", help="Default job queue for jobs in the workflow")
+parser.add_argument("--submit-rate", type=float, default=10, help="Submit at most this many jobs per second")
+parser.add_argument("--max-concurrency", type=int, default=16, help="Submit at most this many jobs at once")
+parser.add_argument("--dry-run", action="store_true", help="Gather arguments and stop short of submitting jobs")
 
 def terminate(args):
     return clients.batch.terminate_job(jobId=args.job_id, reason="Terminated by {}".format(__name__))
@@ -426,14 +1031,33 @@ def terminate(args):
 parser = register_parser(terminate, parent=batch_parser, help="Terminate a Batch job")
 parser.add_argument("job_id")
 
-def ls(args, page_size=100):
-    table, job_ids = [], []
-    for q in args.queues or [q["jobQueueName"] for q in clients.batch.describe_job_queues()["jobQueues"]]:
-        for s in args.status:
-            job_ids.extend(j["jobId"] for j in clients.batch.list_jobs(jobQueue=q, jobStatus=s)["jobSummaryList"])
-    for i in range(0, len(job_ids), page_size):
-        table.extend(clients.batch.describe_jobs(jobs=job_ids[i:i + page_size])["jobs"])
-    page_output(tabulate(table, args, cell_transforms={"createdAt": Timestamp}))
+def format_array_properties(array_properties, job):
+    if not array_properties:
+        return None
+    if "index" in array_properties:
+        return "index {}".format(array_properties["index"])
+    status_counts = ", ".join("{} {}".format(n, s) for s, n in (get_array_status_summary(job) or {}).items())
+    return "size {}: {}".format(array_properties["size"], status_counts)
+
+def ls(args):
+    job_store = JobStore()
+    if args.array_job:
+        table = list_array_job_children(args.array_job, args.status)
+    else:
+        table = job_store.list_jobs(args.queues or get_job_queue_names(), args.status,
+                                    created_after=timestamp(args.created_after) * 1000)
+    # Job summaries have no container, parameter or job definition details; describe the jobs only if those are needed
+    missing_columns = [c for c in args.columns if any(c.split(".")[0] not in job for job in table)]
+    if args.no_describe:
+        if missing_columns:
+            logger.warn("Columns not available without describing jobs: %s", ", ".join(missing_columns))
+        args.columns = [c for c in args.columns if c not in missing_columns]
+        if getattr(args, "sort_by", None) and args.sort_by.split(":")[0] not in args.columns:
+            args.sort_by = None
+    elif missing_columns:
+        table = job_store.describe([job["jobId"] for job in table])
+    cell_transforms = {"createdAt": Timestamp, "arrayProperties": format_array_properties}
+    page_output(tabulate(table, args, cell_transforms=cell_transforms))
 
 job_status_colors = dict(SUBMITTED=YELLOW(), PENDING=YELLOW(), RUNNABLE=BOLD() + YELLOW(),
                          STARTING=GREEN(), RUNNING=GREEN(),
@@ -441,10 +1065,91 @@ job_status_colors = dict(SUBMITTED=YELLOW(), PENDING=YELLOW(), RUNNABLE=BOLD() +
 job_states = job_status_colors.keys()
 parser = register_listing_parser(ls, parent=batch_parser, help="List Batch jobs")
 parser.add_argument("--queues", nargs="+")
+parser.add_argument("--array-job", metavar="JOB_ID", help="List the child jobs of this array job")
 parser.add_argument("--status", nargs="+", default=job_states, choices=job_states)
+parser.add_argument("--created-after", type=Timestamp, default=Timestamp("-24h"), metavar="START",
+                    help="Skip SUCCEEDED and FAILED jobs created before this time. " + Timestamp.__doc__)
+parser.add_argument("--no-describe", action="store_true",
+                    help="List jobs from job summaries only, skipping columns that require describing each job")
+
+def get_job_stats(jobs, percentiles=(50, 90, 99)):
+    """
+    Compute queue wait, run time and turnaround time percentiles (in seconds), throughput per hour, peak concurrency
+    and failure counts by status reason for a list of finished job descriptions or summaries. Batch records no time
+    for the end of instance start-up, so queue wait (createdAt to startedAt) includes it.
+    """
+    import numpy as np
+
+    def get_times(field):
+        return np.array([np.nan if job.get(field) is None else job[field] for job in jobs], dtype=float) / 1000
+
+    def get_peak(starts, stops, weights):
+        # Running total of weights, adding at each start and subtracting at each stop; stops sort first on ties
+        order = np.argsort(np.concatenate([stops, starts]), kind="mergesort")
+        return np.cumsum(np.concatenate([-weights, weights])[order]).max()
+
+    created, started, stopped = get_times("createdAt"), get_times("startedAt"), get_times("stoppedAt")
+    failed = np.array([job["status"] == "FAILED" for job in jobs], dtype=bool)
+    stats = collections.OrderedDict(jobs=len(jobs), failed=int(failed.sum()),
+                                    failure_rate=float(failed.mean()) if len(jobs) else None)
+    for name, durations in ("queue_wait", started - created), ("run_time", stopped - started), (
+            "turnaround", stopped - created):
+        durations = durations[~np.isnan(durations)]
+        stats[name] = collections.OrderedDict()
+        for p in percentiles:
+            stats[name]["p{}".format(p)] = float(np.percentile(durations, p)) if len(durations) else None
+        stats[name]["max"] = float(durations.max()) if len(durations) else None
+    finished = stopped[~np.isnan(stopped)]
+    if len(finished):
+        per_hour = np.bincount(((finished - finished.min()) // 3600).astype(int))
+        stats["throughput_per_hour"] = collections.OrderedDict(mean=float(per_hour.mean()), peak=int(per_hour.max()))
+    ran = ~np.isnan(started) & ~np.isnan(stopped)
+    if ran.any():
+        stats["peak_running_jobs"] = int(get_peak(started[ran], stopped[ran], np.ones(ran.sum())))
+        vcpus = np.array([job.get("container", {}).get("vcpus", np.nan) for job in jobs], dtype=float)[ran]
+        if not np.isnan(vcpus).any():
+            stats["peak_running_vcpus"] = int(get_peak(started[ran], stopped[ran], vcpus))
+    reasons, counts = np.unique([job.get("statusReason", "") for job in jobs if job["status"] == "FAILED"],
+                                return_counts=True)
+    stats["failure_reasons"] = collections.OrderedDict(
+        (str(reasons[i]), int(counts[i])) for i in np.argsort(-counts, kind="mergesort")
+    )
+    return stats
+
+def stats(args):
+    try:
+        import numpy # noqa
+    except ImportError:
+        raise AegeaException("batch stats requires NumPy. Install it with: pip install numpy")
+    start_time, end_time = timestamp(args.start_time) * 1000, timestamp(args.end_time or datetime.now()) * 1000
+    jobs = JobStore().list_jobs(args.queues or get_job_queue_names(), sorted(terminal_job_states),
+                                created_after=start_time)
+    job_stats = get_job_stats([job for job in jobs if job.get("createdAt", 0) <= end_time])
+    if args.json:
+        return job_stats
+    duration_names = ["queue_wait", "run_time", "turnaround"]
+    duration_table = [[name] + list(job_stats.pop(name).values()) for name in duration_names]
+    failure_table = [[reason or "(none)", count] for reason, count in job_stats.pop("failure_reasons").items()]
+    summary_table = []
+    for name, value in job_stats.items():
+        if isinstance(value, dict):
+            summary_table.extend([name + " " + k, v] for k, v in value.items())
+        else:
+            summary_table.append([name, value])
+    page_output("\n\n".join([
+        format_table(summary_table, column_names=["Statistic", "Value"], max_col_width=args.max_col_width),
+        format_table(duration_table, column_names=["Seconds", "p50", "p90", "p99", "max"],
+                     max_col_width=args.max_col_width),
+        format_table(failure_table, column_names=["Failure reason", "Jobs"], max_col_width=args.max_col_width)
+    ]))
+
+parser = register_parser(stats, parent=batch_parser, help="Show Batch job wait time, run time and failure statistics",
+                         description="Show statistics of finished Batch jobs created between START and END")
+parser.add_argument("--queues", nargs="+")
+add_time_bound_args(parser)
 
 def describe(args):
-    return clients.batch.describe_jobs(jobs=[args.job_id])["jobs"][0]
+    return get_job_desc(args.job_id)
 
 parser = register_parser(describe, parent=batch_parser, help="Describe a Batch job")
 parser.add_argument("job_id")
@@ -453,101 +1158,288 @@ def format_job_status(status):
     return job_status_colors[status] + status + ENDC()
 
 class LogReader:
-    log_group_name, next_page_token = "/aws/batch/job", None
+    """
+    Reads events from one CloudWatch Logs stream. Each reader keeps its own position in the stream, so that every
+    read() yields only pages of events that arrived since the previous one. With head, the first head events are read
+    and the reader is then exhausted. With tail, the first read yields the last tail events, and later reads continue
+    forward from there.
+    """
+    log_group_name = "/aws/batch/job"
 
     def __init__(self, log_stream_name, head=None, tail=None):
         self.log_stream_name = log_stream_name
         self.head, self.tail = head, tail
-        self.next_page_key = "nextForwardToken" if self.tail is None else "nextBackwardToken"
-
-    def __iter__(self):
-        page = None
-        get_args = dict(logGroupName=self.log_group_name, logStreamName=self.log_stream_name,
-                        limit=min(self.head or 10000, self.tail or 10000))
-        get_args["startFromHead"] = True if self.tail is None else False
-        if self.next_page_token:
-            get_args["nextToken"] = self.next_page_token
-        while True:
+        self.next_page_token, self.num_read = None, 0
+
+    def read(self):
+        while self.head is None or self.num_read < self.head:
+            get_args = dict(logGroupName=self.log_group_name, logStreamName=self.log_stream_name, startFromHead=True)
+            if self.next_page_token:
+                get_args.update(nextToken=self.next_page_token)
+            elif self.tail is not None:
+                get_args.update(limit=self.tail, startFromHead=False)
+            if self.head is not None:
+                get_args.update(limit=min(self.head - self.num_read, 10000))
             page = clients.logs.get_log_events(**get_args)
-            for event in page["events"]:
-                if "timestamp" in event and "message" in event:
-                    yield event
-            get_args["nextToken"] = page[self.next_page_key]
-            if self.head is not None or self.tail is not None or len(page["events"]) == 0:
+            page_events = [e for e in page["events"] if "timestamp" in e and "message" in e]
+            self.num_read += len(page_events)
+            self.next_page_token = page["nextForwardToken"]
+            yield page_events
+            at_end = not page["events"] or self.next_page_token == get_args.get("nextToken")
+            if at_end or (self.tail is not None and "nextToken" not in get_args):
                 break
-        if page:
-            LogReader.next_page_token = page[self.next_page_key]
+
+def read_ahead(pages, executor):
+    """
+    Return an iterator over the events in an iterator of pages. The first page is requested in executor right away,
+    and each following page while the one before it is consumed.
+    """
+    futures = [executor.submit(next, pages, None)]
+
+    def consume():
+        while True:
+            page = futures.pop().result()
+            if page is None:
+                return
+            futures.append(executor.submit(next, pages, None))
+            for event in page:
+                yield event
+    return consume()
+
+def read_logs(readers, writer, max_workers=16):
+    """
+    Read new events from all the given readers concurrently, and write them to writer in timestamp order as they
+    arrive. readers is a dict mapping each reader to the prefix (or None) to write before its events.
+    """
+    readers = list(readers.items())
+
+    def order_events(i, events):
+        for j, event in enumerate(events):
+            yield event["timestamp"], i, j, event
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        streams = [order_events(i, read_ahead(reader.read(), executor)) for i, (reader, prefix) in enumerate(readers)]
+        for _, i, j, event in heapq.merge(*streams):
+            writer.write(event, source=readers[i][1])
+    writer.flush()
+
+def resolve_log_streams(names, job_store=None):
+    """
+    Return an ordered dict mapping log stream names to the job IDs (or log stream names) they are labeled with. Each
+    name may be a log stream name, a job ID, or the ID of an array job, which resolves to the log streams of all of its
+    child jobs that have started.
+    """
+    log_streams, job_store = collections.OrderedDict(), job_store or JobStore()
+    for name in names:
+        if not re.match(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(:\d+)?$", name):
+            log_streams[name] = name
+            continue
+        job_descs = job_store.describe([name])
+        if job_descs and get_array_status_summary(job_descs[0]) is not None:
+            children = list_array_job_children(name, ["RUNNING", "SUCCEEDED", "FAILED"])
+            children.sort(key=lambda job: job["arrayProperties"]["index"])
+            job_descs = job_store.describe([job["jobId"] for job in children])
+        for job_desc in job_descs:
+            if job_desc.get("container", {}).get("logStreamName"):
+                log_streams[job_desc["container"]["logStreamName"]] = job_desc["jobId"]
+    return log_streams
 
 def get_logs(args):
-    for event in LogReader(args.log_stream_name, head=args.head, tail=args.tail):
-        print(str(Timestamp(event["timestamp"])), event["message"])
+    log_streams = resolve_log_streams(args.log_stream_names)
+    readers = {LogReader(name, head=args.head, tail=args.tail): label if len(log_streams) > 1 else None
+               for name, label in log_streams.items()}
+    with LogWriter(mode="ndjson" if args.json else args.format) as writer:
+        read_logs(readers, writer)
 
-def save_job_desc(job_desc):
-    try:
-        cprops = dict(image="busybox", vcpus=1, memory=4,
-                      environment=[dict(name="job_desc", value=json.dumps(job_desc))])
-        jd_name = "{}_job_desc_{}".format(__name__.replace(".", "_"), job_desc["jobId"])
-        clients.batch.register_job_definition(jobDefinitionName=jd_name, type="container", containerProperties=cprops)
-    except Exception as e:
-        logger.debug("Error while saving job description: %s", e)
-
-def get_job_desc(job_id):
+def get_job_desc(job_id, job_store=None):
+    job_store = job_store or JobStore()
     try:
-        return clients.batch.describe_jobs(jobs=[job_id])["jobs"][0]
+        return job_store.describe([job_id])[0]
     except IndexError:
-        jd_name = "{}_job_desc_{}".format(__name__.replace(".", "_"), job_id)
+        # Older versions of aegea saved descriptions of watched jobs in throwaway job definitions (see
+        # "aegea batch migrate-job-descs")
+        jd_name = legacy_job_desc_prefix + job_id
         jd = clients.batch.describe_job_definitions(jobDefinitionName=jd_name)["jobDefinitions"][0]
-        return json.loads(jd["containerProperties"]["environment"][0]["value"])
+        job_desc = json.loads(jd["containerProperties"]["environment"][0]["value"])
+        job_store.save([job_desc])
+        return job_desc
+
+legacy_job_desc_prefix = "{}_job_desc_".format(__name__.replace(".", "_"))
+
+def migrate_job_descs(args):
+    """
+    Move the job descriptions that older versions of aegea saved in job definitions to the job archive, and deregister
+    those job definitions once the archive segment holding them has been written.
+    """
+    job_store = JobStore(archive=JobArchive())
+    jds = [jd for jd in paginate(clients.batch.get_paginator("describe_job_definitions"), status="ACTIVE")
+           if jd["jobDefinitionName"].startswith(legacy_job_desc_prefix)]
+    for chunk in chunked(jds, 1000):
+        job_descs = [json.loads(jd["containerProperties"]["environment"][0]["value"]) for jd in chunk]
+        if args.dry_run:
+            logger.info("Would archive %d job descriptions", len(job_descs))
+            continue
+        job_store.save(job_descs)
+        job_store.record_segment(job_store.archive.append(job_descs), job_descs)
+        for jd in chunk:
+            clients.batch.deregister_job_definition(jobDefinition=jd["jobDefinitionArn"])
+        logger.info("Archived %d job descriptions and deregistered their job definitions", len(job_descs))
+
+parser = register_parser(migrate_job_descs, parent=batch_parser,
+                         help="Move job descriptions saved by older versions of aegea to the job archive")
+parser.add_argument("--dry-run", action="store_true")
+
+def sync_archive(args):
+    job_store = JobStore(archive=JobArchive())
+    logger.info("Loaded %d job descriptions from the job archive", job_store.sync_archive())
+    logger.info("Added %d job descriptions to the job archive", job_store.archive_stored_jobs())
+
+parser = register_parser(sync_archive, parent=batch_parser, help="Share job descriptions through the S3 job archive",
+                         description="""Load the job descriptions that other hosts have added to the job archive (an
+S3 bucket) into the local job store, and add the descriptions of finished jobs in the local store that are not archived
+yet. Other batch commands only read the local store and Batch, so that they never write to S3.""")
+
+# Upper bounds on the polling interval of batch watch, in seconds, by job status. Polling starts at the minimum
+# interval, resets to it whenever a job changes status, and otherwise backs off towards the bound for the most
+# active status being watched.
+watch_intervals = dict(SUBMITTED=1, PENDING=2, STARTING=1, RUNNING=5, RUNNABLE=30)
+
+def format_status_counts(counts):
+    return ", ".join("{} {}".format(n, format_job_status(s)) for s, n in sorted(counts.items()))
+
+def log_job_status(job_desc, last_job_desc=None):
+    if job_desc["status"] != (last_job_desc or {}).get("status"):
+        logger.info("Job %s (%s) %s", job_desc["jobId"], job_desc["jobName"], format_job_status(job_desc["status"]))
+    if get_array_status_summary(job_desc) is not None:
+        logger.info("Array job %s: %s", job_desc["jobId"], format_status_counts(get_array_status_summary(job_desc)))
+    elif job_desc["status"] in {"RUNNING", "SUCCEEDED", "FAILED"}:
+        logger.info("Job %s log stream: %s", job_desc["jobId"], job_desc.get("container", {}).get("logStreamName"))
+    if "statusReason" in job_desc:
+        logger.info("Job %s: %s", job_desc["jobId"], job_desc["statusReason"])
 
 def watch(args):
-    job_desc = get_job_desc(args.job_id)
-    args.job_name = job_desc["jobName"]
-    logger.info("Watching job %s (%s)", args.job_id, args.job_name)
-    last_status = None
-    while last_status not in {"SUCCEEDED", "FAILED"}:
-        job_desc = get_job_desc(args.job_id)
-        if job_desc["status"] != last_status:
-            logger.info("Job %s %s", args.job_id, format_job_status(job_desc["status"]))
-            last_status = job_desc["status"]
-            if job_desc["status"] in {"RUNNING", "SUCCEEDED", "FAILED"}:
-                logger.info("Job %s log stream: %s", args.job_id, job_desc.get("container", {}).get("logStreamName"))
-                save_job_desc(job_desc)
-        if job_desc["status"] in {"RUNNING", "SUCCEEDED", "FAILED"} and "logStreamName" in job_desc["container"]:
-            args.log_stream_name = job_desc["container"]["logStreamName"]
-            get_logs(args)
-        if "statusReason" in job_desc:
-            logger.info("Job %s: %s", args.job_id, job_desc["statusReason"])
-        time.sleep(0.2)
-
-get_logs_parser = register_parser(get_logs, parent=batch_parser, help="Retrieve logs for a Batch job")
-get_logs_parser.add_argument("log_stream_name")
-watch_parser = register_parser(watch, parent=batch_parser, help="Monitor a running Batch job and stream its logs")
-watch_parser.add_argument("job_id")
+    job_store, job_ids, jobs, log_readers = JobStore(), list(args.job_ids), {}, {}
+    if args.queue:
+        active_states = [s for s in job_states if s not in terminal_job_states]
+        job_ids.extend(job["jobId"] for job in list_all_jobs([args.queue], active_states))
+    if not job_ids:
+        raise AegeaException("No jobs to watch")
+    logger.info("Watching %d job(s)", len(job_ids))
+    poll_interval = min(watch_intervals.values())
+    writer = LogWriter(mode="ndjson" if args.json else args.format)
+    while True:
+        active_job_ids = [j for j in job_ids if jobs.get(j, {}).get("status") not in terminal_job_states]
+        # One DescribeJobs request per 100 active jobs per tick
+        job_descs = job_store.describe(active_job_ids)
+        if not jobs:
+            found = {job_desc["jobId"] for job_desc in job_descs}
+            job_descs.extend(get_job_desc(job_id, job_store) for job_id in job_ids if job_id not in found)
+        status_changed = False
+        for job_desc in job_descs:
+            # Array jobs also change status whenever any of their child jobs do
+            last_job_desc = jobs.get(job_desc["jobId"], {})
+            last_status = last_job_desc.get("status"), get_array_status_summary(last_job_desc)
+            if last_status != (job_desc["status"], get_array_status_summary(job_desc)):
+                log_job_status(job_desc, last_job_desc)
+                status_changed = True
+            if job_desc["status"] == "FAILED" and get_array_status_summary(job_desc):
+                failed_children = list_array_job_children(job_desc["jobId"], ["FAILED"])
+                logger.info("Array job %s: failed child jobs: %s", job_desc["jobId"],
+                            " ".join(sorted(job["jobId"] for job in failed_children)))
+            jobs[job_desc["jobId"]] = job_desc
+            log_stream_name = job_desc.get("container", {}).get("logStreamName")
+            if job_desc["status"] in {"RUNNING", "SUCCEEDED", "FAILED"} and log_stream_name:
+                if job_desc["jobId"] not in log_readers:
+                    log_readers[job_desc["jobId"]] = LogReader(log_stream_name, head=args.head, tail=args.tail)
+        # Logs of all jobs that have started are read concurrently, and prefixed with the job ID if there are several
+        active_log_readers = {log_readers[j["jobId"]]: j["jobId"] if len(job_ids) > 1 else None
+                              for j in job_descs if j["jobId"] in log_readers}
+        read_logs(active_log_readers, writer)
+        if len(job_ids) > 1 and status_changed:
+            # Array jobs are counted by the statuses of their child jobs
+            counts = collections.Counter()
+            for job_id in job_ids:
+                counts.update(get_array_status_summary(jobs[job_id]) or {jobs[job_id]["status"]: 1})
+            logger.info("Jobs: %s", format_status_counts(counts))
+        if all(jobs[j]["status"] in terminal_job_states for j in job_ids):
+            break
+        if status_changed:
+            poll_interval = min(watch_intervals.values())
+        else:
+            max_interval = min(watch_intervals.get(jobs[j]["status"], 1) for j in active_job_ids)
+            poll_interval = min(poll_interval * 2, max_interval)
+        time.sleep(poll_interval)
+
+get_logs_parser = register_parser(get_logs, parent=batch_parser, help="Retrieve logs for Batch jobs")
+get_logs_parser.add_argument("log_stream_names", nargs="+", metavar="log_stream_or_job_id",
+                             help="Log stream names or job IDs. Array job IDs select the logs of all their child jobs")
+watch_parser = register_parser(watch, parent=batch_parser, help="Monitor running Batch jobs and stream their logs")
+watch_parser.add_argument("job_ids", nargs="*", metavar="JOB_ID")
+watch_parser.add_argument("--queue", help="Watch all jobs in this queue that have not yet finished")
 for parser in get_logs_parser, watch_parser:
     lines_group = parser.add_mutually_exclusive_group()
     lines_group.add_argument("--head", type=int, nargs="?", const=10,
                              help="Retrieve this number of lines from the beginning of the log (default 10)")
     lines_group.add_argument("--tail", type=int, nargs="?", const=10,
                              help="Retrieve this number of lines from the end of the log (default 10)")
+    add_log_format_arg(parser)
 
-def ssh(args):
-    job_desc = clients.batch.describe_jobs(jobs=[args.job_id])["jobs"][0]
+def get_ecs_clusters(job_desc):
+    # Container instance ARNs in the long ARN format include the cluster name; otherwise, the cluster is looked up via
+    # the compute environments of the job queue
+    ecs_ci_arn = ARN(job_desc["container"]["containerInstanceArn"])
+    if ecs_ci_arn.resource.count("/") == 2:
+        return [ecs_ci_arn.resource.split("/")[1]]
     job_queue_desc = clients.batch.describe_job_queues(jobQueues=[job_desc["jobQueue"]])["jobQueues"][0]
-    ce = job_queue_desc["computeEnvironmentOrder"][0]["computeEnvironment"]
-    ce_desc = clients.batch.describe_compute_environments(computeEnvironments=[ce])["computeEnvironments"][0]
+    ces = [ce["computeEnvironment"] for ce in job_queue_desc["computeEnvironmentOrder"]]
+    return [ce["ecsClusterArn"] for ce in clients.batch.describe_compute_environments(computeEnvironments=ces)
+            ["computeEnvironments"]]
+
+def resolve_job_host(job_id):
+    """
+    Return the EC2 instance ID and public DNS name of the host running a Batch job. Hosts are cached for as long as
+    the job is running, so that only the job itself is described on later calls.
+    """
+    job_desc = JobStore().describe([job_id])[0]
+    job_hosts = JSONCache("batch_job_hosts_cache")
+    if job_desc["status"] != "RUNNING":
+        job_hosts.pop(job_id, None)
+        job_hosts.save()
+        raise AegeaException("Job {} is {}, not RUNNING".format(job_id, job_desc["status"]))
     ecs_ci_arn = job_desc["container"]["containerInstanceArn"]
-    ecs_ci_desc = clients.ecs.describe_container_instances(cluster=ce_desc["ecsClusterArn"],
-                                                           containerInstances=[ecs_ci_arn])["containerInstances"][0]
-    ecs_ci_ec2_id = ecs_ci_desc["ec2InstanceId"]
-    for reservation in paginate(clients.ec2.get_paginator("describe_instances"), InstanceIds=[ecs_ci_ec2_id]):
-        ecs_ci_address = reservation["Instances"][0]["PublicDnsName"]
-    logger.info("Job {} is on ECS container instance {} ({})".format(args.job_id, ecs_ci_ec2_id, ecs_ci_address))
-    ssh_args = ["ssh", "-l", "ec2-user", ecs_ci_address,
-                "docker", "ps", "--filter", "name=" + args.job_id, "--format", "{{.ID}}"]
-    logger.info("Running: {}".format(" ".join(ssh_args)))
-    container_id = subprocess.check_output(ssh_args).decode().strip()
-    subprocess.call(["ssh", "-t", "-l", "ec2-user", ecs_ci_address,
-                     "docker", "exec", "--interactive", "--tty", container_id] + (args.ssh_args or ["/bin/bash", "-l"]))
+    if job_hosts.get(job_id, {}).get("container_instance_arn") != ecs_ci_arn:
+        for cluster in get_ecs_clusters(job_desc):
+            res = clients.ecs.describe_container_instances(cluster=cluster, containerInstances=[ecs_ci_arn])
+            if res["containerInstances"]:
+                instance_id = res["containerInstances"][0]["ec2InstanceId"]
+                break
+        else:
+            raise AegeaException("Unable to find the ECS container instance of job {}".format(job_id))
+        instance = clients.ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+        # Forget hosts of jobs that were started more than a week ago
+        for cached_job_id, job_host in list(job_hosts.items()):
+            if job_host["job_started_at"] < (time.time() - 7 * 86400) * 1000:
+                del job_hosts[cached_job_id]
+        job_hosts[job_id] = dict(container_instance_arn=ecs_ci_arn, instance_id=instance_id,
+                                 address=instance["PublicDnsName"],
+                                 job_started_at=job_desc.get("startedAt", time.time() * 1000))
+        job_hosts.save()
+    return job_hosts[job_id]["instance_id"], job_hosts[job_id]["address"]
+
+def ssh(args):
+    instance_id, address = resolve_job_host(args.job_id)
+    logger.info("Job %s is on ECS container instance %s (%s)", args.job_id, instance_id, address)
+    # The container is looked up and attached to in one SSH session. The connection is kept open for a minute after
+    # the session ends, and reused by later sessions to the same host. %C expands to a fixed-length hash of the
+    # connection parameters, which keeps the socket path under the Unix domain socket path length limit.
+    control_path = os.path.join(config.user_config_dir, "ssh-%C")
+    remote_command = """docker exec --interactive --tty "$(docker ps --filter name={} --format '{{{{.ID}}}}')" {}"""
+    remote_command = remote_command.format(shell_quote(args.job_id),
+                                           " ".join(shell_quote(a) for a in (args.ssh_args or ["/bin/bash", "-l"])))
+    ssh_args = ["ssh", "-t", "-l", "ec2-user", "-o", "ControlMaster=auto", "-o", "ControlPath=" + control_path,
+                "-o", "ControlPersist=60", address, remote_command]
+    logger.info("Running: %s", " ".join(ssh_args))
+    subprocess.call(ssh_args)
 
 ssh_parser = register_parser(ssh, parent=batch_parser, help="Log in to a running Batch job via SSH")
 ssh_parser.add_argument("job_id")
@@ -42,7 +42,7 @@ def ls(args):
         table.append(bucket)
     page_output(tabulate(table, args))
 
-parser = register_filtering_parser(ls, parent=buckets_parser)
+parser = register_filtering_parser(ls, parent=buckets_parser, regional=False)
 
 def lifecycle(args):
     if args.delete:
@@ -26,7 +26,8 @@ def ls(args):
     @lru_cache()
     def instance_id_to_name(i):
         return add_name(resources.ec2.Instance(i)).name
-    table = [{f: get_cell(i, f) for f in args.columns} for i in filter_collection(resources.ec2.volumes, args)]
+    volumes = filter_collection(resources.ec2.volumes, args, resource_type="ec2.Volume")
+    table = [{f: get_cell(i, f) for f in args.columns} for i in volumes]
     if "attachments" in args.columns:
         for row in table:
             row["attachments"] = ", ".join(instance_id_to_name(a["InstanceId"]) for a in row["attachments"])
@@ -35,7 +36,8 @@ def ls(args):
 parser = register_filtering_parser(ls, parent=ebs_parser, help="List EC2 EBS volumes")
 
 def snapshots(args):
-    page_output(filter_and_tabulate(resources.ec2.snapshots.filter(OwnerIds=[ARN.get_account_id()]), args))
+    snapshots = resources.ec2.snapshots.filter(OwnerIds=[ARN.get_account_id()])
+    page_output(filter_and_tabulate(snapshots, args, resource_type="ec2.Snapshot"))
 
 parser = register_filtering_parser(snapshots, parent=ebs_parser, help="List EC2 EBS snapshots")
 
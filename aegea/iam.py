@@ -44,22 +44,22 @@ def users(args):
     cell_transforms = {"cur": mark_cur_user, "policies": get_policies_for_principal, "mfa": describe_mfa}
     page_output(tabulate(users, args, cell_transforms=cell_transforms))
 
-parser = register_listing_parser(users, parent=iam_parser, help="List IAM users")
+parser = register_listing_parser(users, parent=iam_parser, help="List IAM users", regional=False)
 
 def groups(args):
     page_output(tabulate(resources.iam.groups.all(), args, cell_transforms={"policies": get_policies_for_principal}))
 
-parser = register_listing_parser(groups, parent=iam_parser, help="List IAM groups")
+parser = register_listing_parser(groups, parent=iam_parser, help="List IAM groups", regional=False)
 
 def roles(args):
     page_output(tabulate(resources.iam.roles.all(), args, cell_transforms={"policies": get_policies_for_principal}))
 
-parser = register_listing_parser(roles, parent=iam_parser, help="List IAM roles")
+parser = register_listing_parser(roles, parent=iam_parser, help="List IAM roles", regional=False)
 
 def policies(args):
     page_output(tabulate(resources.iam.policies.all(), args))
 
-parser = register_listing_parser(policies, parent=iam_parser, help="List IAM policies")
+parser = register_listing_parser(policies, parent=iam_parser, help="List IAM policies", regional=False)
 parser.add_argument("--sort-by")
 
 def generate_password(length=16):
@@ -103,7 +103,7 @@ def create_user(args):
         user.add_group(GroupName=group.name)
         logger.info("Added %s to %s", user, group)
 
-parser = register_listing_parser(create_user, parent=iam_parser, help="Create a new IAM user")
+parser = register_listing_parser(create_user, parent=iam_parser, help="Create a new IAM user", regional=False)
 parser.add_argument("username")
 parser.add_argument("--reset-password", action="store_true")
 parser.add_argument("--prompt-for-password",
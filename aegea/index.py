@@ -0,0 +1,53 @@
+"""
+Manage the local resource index.
+
+``aegea index sync`` snapshots EC2 instances, volumes, snapshots, AMIs, security groups and subnets, ECS tasks, Batch
+jobs, CloudWatch Logs groups and Route53 records in the current region into a SQLite database in the aegea config
+directory. Listing commands that accept ``--offline`` (such as ``aegea ls``, ``aegea images``, ``aegea subnets`` and
+``aegea ebs ls``) then answer from the index without calling AWS APIs. Re-run ``aegea index sync`` to refresh it.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys, argparse
+
+from . import register_parser
+from .ls import register_listing_parser, add_regions_arg
+from .util.printing import page_output, tabulate
+from .util.aws.index import ResourceIndex, indexed_types
+
+def index(args):
+    index_parser.print_help()
+
+index_parser = register_parser(index, help="Manage the local resource index", description=__doc__,
+                               formatter_class=argparse.RawTextHelpFormatter)
+
+def sync(args):
+    counts = ResourceIndex().sync(types=args.types)
+    return {resource_type: dict(count=count) for resource_type, count in counts.items()}
+
+parser = register_parser(sync, parent=index_parser, help="Snapshot resources into the local resource index")
+parser.add_argument("types", nargs="*", metavar="TYPE",
+                    help="Resource types to index (default: all). Choose from: " + ", ".join(indexed_types))
+add_regions_arg(parser)
+
+def status(args):
+    page_output(tabulate(ResourceIndex().status(), args))
+
+parser = register_listing_parser(status, parent=index_parser, help="Show when each resource type was last indexed",
+                                 column_defaults=["type", "account_id", "count", "synced_at"])
+
+def query(args):
+    results = ResourceIndex().query(args.type, filters=[f.split("=", 1) for f in args.filter],
+                                    tags=[t.split("=", 1) for t in args.tag], sort_by=args.sort_by, limit=args.limit)
+    table = [dict(r["data"], **{k: v for k, v in r.items() if k != "data"}) for r in results]
+    page_output(tabulate(table, args))
+
+parser = register_listing_parser(query, parent=index_parser, help="List indexed resources of any type",
+                                 column_defaults=["id", "name", "state", "created_at"])
+parser.add_argument("type", choices=list(indexed_types))
+parser.add_argument("-f", "--filter", nargs="+", default=[], metavar="FILTER_NAME=VALUE",
+                    help="Filter(s) to apply to output, e.g. --filter state=available")
+parser.add_argument("-t", "--tag", nargs="+", default=[], metavar="TAG_NAME=VALUE", help="Tag(s) to filter output by")
+parser.add_argument("--sort-by")
+parser.add_argument("--limit", type=int, help="Print at most this many results")
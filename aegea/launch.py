@@ -16,15 +16,16 @@ The return value (stdout) is a JSON object with one key, ``instance_id``.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, time, datetime, base64, json
+import os, sys, time, datetime, base64, json, collections
 
 from . import register_parser, logger, config
 
-from .util import wait_for_port, validate_hostname, paginate
+from .util import wait_for_port, validate_hostname, paginate, ThreadPoolExecutor
 from .util.cloudinit import get_user_data
 from .util.aws import (ensure_vpc, ensure_subnet, ensure_security_group, DNSZone, get_client_token, ensure_log_group,
                        ensure_instance_profile, add_tags, resolve_security_group, get_bdm, resolve_instance_id,
-                       expect_error_codes, resolve_ami, get_ondemand_price_usd, resources, clients, ARN)
+                       expect_error_codes, resolve_ami, get_ondemand_price_usd, resources, clients, ARN,
+                       EnsuredResources, reverify_ensured_resources_on_error, in_own_session)
 from .util.aws.spot import SpotFleetBuilder
 from .util.crypto import new_ssh_key, add_ssh_host_key_to_known_hosts, ensure_ssh_key, hostkey_line
 from .util.exceptions import AegeaException
@@ -43,45 +44,103 @@ def get_startup_commands(args, username):
         "ssh -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no {}@localhost -N || true".format(username)
     ] + args.commands
 
-def launch(args):
-    if args.spot_price or args.duration_hours or args.cores or args.min_mem_per_core_gb:
-        args.spot = True
-    if args.use_dns:
-        dns_zone = DNSZone(config.dns.get("private_zone"))
-        config.dns.private_zone = dns_zone.zone["Name"]
-    ssh_key_name = ensure_ssh_key(name=args.ssh_key_name, base_name=__name__,
-                                  verify_pem_file=args.verify_ssh_key_pem_file)
+def run_preflight_steps(steps):
+    """
+    Run the steps of a dependency graph concurrently, and return a dict of their results. steps is an ordered mapping of
+    each step name to a tuple of the names of the steps it depends on (which must come before it) and a function that
+    is called with their results. The time each step spent waiting for its dependencies and running is logged.
+    """
+    futures, timings, start = {}, {}, time.time()
+
+    def run_step(name, dependencies, fn):
+        inputs = [futures[dependency].result() for dependency in dependencies]
+        step_start = time.time()
+        try:
+            with in_own_session():
+                return fn(*inputs)
+        finally:
+            timings[name] = (step_start - start, time.time() - step_start)
+
+    # Every step gets its own thread, so steps waiting for their dependencies never starve the steps they wait on
+    try:
+        with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            for name, (dependencies, fn) in steps.items():
+                futures[name] = executor.submit(run_step, name, dependencies, fn)
+            return {name: future.result() for name, future in futures.items()}
+    finally:
+        for name, (started_at, duration) in sorted(timings.items(), key=lambda i: i[1]):
+            logger.debug("Pre-flight step %s started at %.2fs and took %.2fs", name, started_at, duration)
+        logger.debug("Pre-flight took %.2fs (%.2fs if run in sequence)", time.time() - start,
+                     sum(duration for started_at, duration in timings.values()))
+
+def check_hostname(hostname):
+    try:
+        i = resolve_instance_id(hostname)
+        msg = "The hostname {} is being used by {} (state: {})"
+        raise Exception(msg.format(hostname, i, resources.ec2.Instance(i).state["Name"]))
+    except AegeaException:
+        validate_hostname(hostname)
+        assert not hostname.startswith("i-")
+
+def ensure_syslog_group():
     # TODO: move all account init checks into init helper with region-specific semaphore on s3
     try:
         ensure_log_group("syslog")
     except ClientError:
         logger.warn("Unable to query or create cloudwatch syslog group. Logs may be undeliverable")
-    try:
-        i = resolve_instance_id(args.hostname)
-        msg = "The hostname {} is being used by {} (state: {})"
-        raise Exception(msg.format(args.hostname, i, resources.ec2.Instance(i).state["Name"]))
-    except AegeaException:
-        validate_hostname(args.hostname)
-        assert not args.hostname.startswith("i-")
-    ami_tags = dict(tag.split("=", 1) for tag in args.ami_tags or [])
-    args.ami = resolve_ami(args.ami, **ami_tags)
-    if args.subnet:
-        subnet = resources.ec2.Subnet(args.subnet)
+
+def resolve_network(subnet_id=None):
+    if subnet_id:
+        subnet = resources.ec2.Subnet(subnet_id)
         vpc = resources.ec2.Vpc(subnet.vpc_id)
     else:
         vpc = ensure_vpc()
         subnet = ensure_subnet(vpc)
-    if not subnet.map_public_ip_on_launch:
-        raise AegeaException("Subnets without public IP mapping are not supported")
+    # Loading the subnet is the first use of a cached VPC and subnet
+    with EnsuredResources.verify_on_error():
+        if not subnet.map_public_ip_on_launch:
+            raise AegeaException("Subnets without public IP mapping are not supported")
+    return vpc, subnet
 
-    if args.security_groups:
-        security_groups = [resolve_security_group(sg, vpc) for sg in args.security_groups]
-    else:
-        security_groups = [ensure_security_group(__name__, vpc)]
+def resolve_security_groups(security_group_names, vpc):
+    if security_group_names:
+        return [resolve_security_group(sg, vpc) for sg in security_group_names]
+    return [ensure_security_group(__name__, vpc)]
 
-    ssh_host_key = new_ssh_key()
+def resolve_dns_zone(use_dns):
+    if use_dns:
+        dns_zone = DNSZone(config.dns.get("private_zone"))
+        config.dns.private_zone = dns_zone.zone["Name"]
+        return dns_zone
+
+@reverify_ensured_resources_on_error
+def launch(args):
+    if args.spot_price or args.duration_hours or args.cores or args.min_mem_per_core_gb:
+        args.spot = True
+    ami_tags = dict(tag.split("=", 1) for tag in args.ami_tags or [])
+    # Pre-flight steps mostly wait on independent API calls, so they run concurrently except where one needs another
+    preflight = run_preflight_steps(collections.OrderedDict([
+        ("dns_zone", ((), lambda: resolve_dns_zone(args.use_dns))),
+        ("ssh_key", ((), lambda: ensure_ssh_key(name=args.ssh_key_name, base_name=__name__,
+                                                verify_pem_file=args.verify_ssh_key_pem_file))),
+        ("log_group", ((), ensure_syslog_group)),
+        ("hostname", ((), lambda: check_hostname(args.hostname))),
+        ("ami", ((), lambda: resolve_ami(args.ami, **ami_tags))),
+        # Steps that create VPC and IAM resources wait for the hostname check, so a launch that is rejected for its
+        # hostname leaves nothing behind
+        ("network", (("hostname",), lambda _: resolve_network(args.subnet))),
+        ("security_groups", (("hostname", "network"),
+                             lambda _, network: resolve_security_groups(args.security_groups, network[0]))),
+        ("ssh_host_key", ((), new_ssh_key)),
+        ("iam_username", ((), ARN.get_iam_username)),
+        ("instance_profile", (("hostname",), lambda _: ensure_instance_profile(args.iam_role,
+                                                                               policies=args.iam_policies)
+                              if args.iam_role else None))
+    ]))
+    ssh_key_name, args.ami, security_groups = preflight["ssh_key"], preflight["ami"], preflight["security_groups"]
+    subnet, ssh_host_key = preflight["network"][1], preflight["ssh_host_key"]
     user_data_args = dict(host_key=ssh_host_key,
-                          commands=get_startup_commands(args, ARN.get_iam_username()),
+                          commands=get_startup_commands(args, preflight["iam_username"]),
                           packages=args.packages,
                           storage=args.storage)
     user_data_args.update(dict(args.cloud_config_data))
@@ -93,14 +152,13 @@ def launch(args):
                        UserData=get_user_data(**user_data_args))
     logger.info("Launch spec user data is %i bytes long", len(launch_spec["UserData"]))
     if args.iam_role:
-        instance_profile = ensure_instance_profile(args.iam_role, policies=args.iam_policies)
-        launch_spec["IamInstanceProfile"] = dict(Arn=instance_profile.arn)
+        launch_spec["IamInstanceProfile"] = dict(Arn=preflight["instance_profile"].arn)
     if not args.spot:
         launch_spec["SubnetId"] = subnet.id
     if args.availability_zone:
         launch_spec["Placement"] = dict(AvailabilityZone=args.availability_zone)
     if args.client_token is None:
-        args.client_token = get_client_token(ARN.get_iam_username(), __name__)
+        args.client_token = get_client_token(preflight["iam_username"], __name__)
     try:
         if args.spot:
             launch_spec["UserData"] = base64.b64encode(launch_spec["UserData"]).decode()
@@ -122,7 +180,8 @@ def launch(args):
                 else:
                     spot_fleet_builder = SpotFleetBuilder(**spot_fleet_args)
                 logger.info("Launching {}".format(spot_fleet_builder))
-                sfr_id = spot_fleet_builder()
+                with EnsuredResources.verify_on_error():
+                    sfr_id = spot_fleet_builder()
                 instances = []
                 while not instances:
                     res = clients.ec2.describe_spot_fleet_instances(SpotFleetRequestId=sfr_id)
@@ -135,20 +194,22 @@ def launch(args):
                 if args.spot_price is None:
                     args.spot_price = get_spot_bid_price(args.instance_type)
                 logger.info("Bidding ${}/hour for a {} spot instance".format(args.spot_price, args.instance_type))
-                res = clients.ec2.request_spot_instances(
-                    SpotPrice=str(args.spot_price),
-                    ValidUntil=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
-                    LaunchSpecification=launch_spec,
-                    ClientToken=args.client_token,
-                    DryRun=args.dry_run
-                )
+                with EnsuredResources.verify_on_error():
+                    res = clients.ec2.request_spot_instances(
+                        SpotPrice=str(args.spot_price),
+                        ValidUntil=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+                        LaunchSpecification=launch_spec,
+                        ClientToken=args.client_token,
+                        DryRun=args.dry_run
+                    )
                 sir_id = res["SpotInstanceRequests"][0]["SpotInstanceRequestId"]
                 clients.ec2.get_waiter("spot_instance_request_fulfilled").wait(SpotInstanceRequestIds=[sir_id])
                 res = clients.ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[sir_id])
                 instance = resources.ec2.Instance(res["SpotInstanceRequests"][0]["InstanceId"])
         else:
-            instances = resources.ec2.create_instances(MinCount=1, MaxCount=1, ClientToken=args.client_token,
-                                                       DryRun=args.dry_run, **launch_spec)
+            with EnsuredResources.verify_on_error():
+                instances = resources.ec2.create_instances(MinCount=1, MaxCount=1, ClientToken=args.client_token,
+                                                           DryRun=args.dry_run, **launch_spec)
             instance = instances[0]
     except ClientError as e:
         expect_error_codes(e, "DryRunOperation")
@@ -157,11 +218,11 @@ def launch(args):
     instance.wait_until_running()
     hkl = hostkey_line(hostnames=[], key=ssh_host_key).strip()
     tags = dict(tag.split("=", 1) for tag in args.tags)
-    add_tags(instance, Name=args.hostname, Owner=ARN.get_iam_username(),
+    add_tags(instance, Name=args.hostname, Owner=preflight["iam_username"],
              SSHHostPublicKeyPart1=hkl[:255], SSHHostPublicKeyPart2=hkl[255:],
              OwnerSSHKeyName=ssh_key_name, **tags)
     if args.use_dns:
-        dns_zone.update(args.hostname, instance.private_dns_name)
+        preflight["dns_zone"].update(args.hostname, instance.private_dns_name)
     while not instance.public_dns_name:
         instance = resources.ec2.Instance(instance.id)
         time.sleep(1)
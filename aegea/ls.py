@@ -3,23 +3,35 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os, sys, copy, time
 from datetime import datetime
+from concurrent.futures import as_completed
 
 from . import register_parser
-from .util import Timestamp, paginate, describe_cidr, add_time_bound_args
+from .util import Timestamp, paginate, chunked, ThreadPoolExecutor, describe_cidr, add_time_bound_args
 from .util.printing import page_output, tabulate, GREEN, BLUE
 from .util.aws import ARN, resolve_instance_id, resources, clients
+from .util.aws.index import ResourceIndex, OfflineResource
+from .util.aws.logs import resolve_log_groups, filter_log_events, follow_log_events, LogWriter, add_log_format_arg
+from .util.cache import JSONCache
 from .util.compat import timestamp
+from .util.exceptions import AegeaException
 
 def column_completer(parser, **kwargs):
     resource = getattr(resources, parser.get_default("resource"))
     subresource = getattr(resource, parser.get_default("subresource"))
     return [attr for attr in dir(subresource("")) if not attr.startswith("_")]
 
+def add_regions_arg(parser):
+    parser.add_argument("--regions", metavar="all|REGION[,REGION...]",
+                        help="Run in each of these regions concurrently, and list the results from all of them")
+
 def register_listing_parser(function, **kwargs):
     col_def = dict(default=kwargs.pop("column_defaults")) if "column_defaults" in kwargs else {}
+    regional = kwargs.pop("regional", True)
     parser = register_parser(function, **kwargs)
     col_arg = parser.add_argument("-c", "--columns", nargs="+", help="Names of columns to print", **col_def)
     col_arg.completer = column_completer
+    if regional:
+        add_regions_arg(parser)
     return parser
 
 def register_filtering_parser(function, **kwargs):
@@ -28,25 +40,34 @@ def register_filtering_parser(function, **kwargs):
                         help="Filter(s) to apply to output, e.g. --filter state=available")
     parser.add_argument("-t", "--tag", nargs="+", default=[], metavar="TAG_NAME=VALUE",
                         help="Tag(s) to filter output by")
+    parser.add_argument("--limit", type=int, help="Print at most this many results")
+    parser.add_argument("--offline", action="store_true",
+                        help='Answer from the local resource index instead of AWS APIs (see "aegea index sync")')
     return parser
 
-def filter_collection(collection, args):
-    filters = []
+def filter_collection(collection, args, resource_type=None):
     # TODO: shlex?
-    for f in getattr(args, "filter", []):
-        name, value = f.split("=", 1)
-        if collection.__class__.__name__ == "ec2.instancesCollectionManager":
-            name = name.replace("_", "-")
-            if name == "state":
-                name = "instance-state-name"
-        filters.append(dict(Name=name, Values=[value]))
-    for t in getattr(args, "tag", []):
-        name, value = t.split("=", 1)
-        filters.append(dict(Name="tag:" + name, Values=[value]))
-    return collection.filter(Filters=filters)
-
-def filter_and_tabulate(collection, args, **kwargs):
-    return tabulate(filter_collection(collection, args), args, **kwargs)
+    filters = [f.split("=", 1) for f in getattr(args, "filter", [])]
+    tags = [t.split("=", 1) for t in getattr(args, "tag", [])]
+    if getattr(args, "offline", False):
+        return query_index(resource_type, filters, tags, args)
+    if collection.__class__.__name__ == "ec2.instancesCollectionManager":
+        filters = [[name.replace("_", "-"), value] for name, value in filters]
+        filters = [["instance-state-name" if name == "state" else name, value] for name, value in filters]
+    filters = [dict(Name=name, Values=[value]) for name, value in filters]
+    filters += [dict(Name="tag:" + name, Values=[value]) for name, value in tags]
+    collection = collection.filter(Filters=filters)
+    return collection.limit(args.limit) if getattr(args, "limit", None) else collection
+
+def query_index(resource_type, filters, tags, args):
+    if resource_type is None:
+        raise AegeaException("This listing is not available offline")
+    results = ResourceIndex().query(resource_type, filters=filters, tags=tags, sort_by=getattr(args, "sort_by", None),
+                                    limit=getattr(args, "limit", None))
+    return [OfflineResource(resource_type, result["id"], result["data"]) for result in results]
+
+def filter_and_tabulate(collection, args, resource_type=None, **kwargs):
+    return tabulate(filter_collection(collection, args, resource_type=resource_type), args, **kwargs)
 
 def add_name(instance):
     instance.name = instance.id
@@ -59,7 +80,7 @@ def ls(args):
     for col in "tags", "launch_time":
         if col not in args.columns:
             args.columns.append(col)
-    instances = [add_name(i) for i in filter_collection(resources.ec2.instances, args)]
+    instances = [add_name(i) for i in filter_collection(resources.ec2.instances, args, resource_type="ec2.Instance")]
     args.columns = ["name"] + args.columns
     cell_transforms = {
         "state": lambda x, r: x["Name"],
@@ -80,31 +101,36 @@ parser = register_parser(console, help="Get console output for an EC2 instance")
 parser.add_argument("instance")
 
 def images(args):
-    page_output(filter_and_tabulate(resources.ec2.images.filter(Owners=["self"]), args))
+    page_output(filter_and_tabulate(resources.ec2.images.filter(Owners=["self"]), args, resource_type="ec2.Image"))
 
 parser = register_filtering_parser(images, help="List EC2 AMIs")
 parser.add_argument("--sort-by")
 
 peer_desc_cache = {}
-def describe_peer(peer):
+def describe_peer(peer, offline=False):
     if "CidrIp" in peer:
         if peer["CidrIp"] not in peer_desc_cache:
             peer_desc_cache[peer["CidrIp"]] = describe_cidr(peer["CidrIp"])
         return peer["CidrIp"], peer_desc_cache[peer["CidrIp"]]
     else:
-        if peer["GroupId"] not in peer_desc_cache:
+        if peer["GroupId"] not in peer_desc_cache and offline:
+            # Groups that are not in the index (in peered VPCs of other accounts) are described by their pair only
+            matches = query_index("ec2.SecurityGroup", [["id", peer["GroupId"]]], [], None)
+            peer_desc_cache[peer["GroupId"]] = matches[0] if matches else OfflineResource(
+                "ec2.SecurityGroup", peer["GroupId"], dict(GroupName=peer.get("GroupName", peer["GroupId"])))
+        elif peer["GroupId"] not in peer_desc_cache:
             peer_desc_cache[peer["GroupId"]] = resources.ec2.SecurityGroup(peer["GroupId"])
         return peer_desc_cache[peer["GroupId"]].group_name, peer_desc_cache[peer["GroupId"]].description
 
 def security_groups(args):
     def format_rule(row, perm, peer, egress=False):
-        peer_desc, row.peer_description = describe_peer(peer)
+        peer_desc, row.peer_description = describe_peer(peer, offline=args.offline)
         row.rule = BLUE("●") + ":" + str(perm.get("FromPort" if egress else "ToPort", "*"))
         row.rule += GREEN("▶") if egress else GREEN("◀")
         row.rule += peer_desc + ":" + str(perm.get("ToPort" if egress else "FromPort", "*"))
         row.proto = "*" if perm["IpProtocol"] == "-1" else perm["IpProtocol"]
     table = []
-    for sg in resources.ec2.security_groups.all():
+    for sg in filter_collection(resources.ec2.security_groups, args, resource_type="ec2.SecurityGroup"):
         for i, perm in enumerate(sg.ip_permissions + sg.ip_permissions_egress):
             for peer in perm["IpRanges"] + perm["UserIdGroupPairs"]:
                 table.append(copy.copy(sg))
@@ -118,6 +144,9 @@ def acls(args):
 
 parser = register_filtering_parser(acls, help="List EC2 network ACLs")
 
+log_group_help = """CloudWatch log group. Separate multiple log groups with commas. Names ending
+in * match all log groups with that prefix, e.g. "/aws/batch/*,syslog,docker"."""
+
 def logs(args):
     if args.log_group and (args.log_stream or args.start_time or args.end_time):
         args.pattern, args.follow = None, False
@@ -126,8 +155,9 @@ def logs(args):
     group_cols = ["logGroupName"]
     stream_cols = ["logStreamName", "lastIngestionTime", "storedBytes"]
     args.columns = group_cols + stream_cols
+    log_groups = resolve_log_groups(args.log_group) if args.log_group else None
     for group in paginate(clients.logs.get_paginator("describe_log_groups")):
-        if args.log_group and group["logGroupName"] != args.log_group:
+        if log_groups is not None and group["logGroupName"] not in log_groups:
             continue
         n = 0
         for stream in paginate(clients.logs.get_paginator("describe_log_streams"),
@@ -143,12 +173,16 @@ def logs(args):
 parser = register_parser(logs, help="List CloudWatch Logs groups and streams")
 parser.add_argument("--max-streams-per-group", "-n", type=int, default=8)
 parser.add_argument("--sort-by", default="lastIngestionTime:reverse")
-parser.add_argument("log_group", nargs="?", help="CloudWatch log group")
+parser.add_argument("log_group", nargs="?", help=log_group_help)
 parser.add_argument("log_stream", nargs="?", help="CloudWatch log stream")
+parser.add_argument("--shards", type=int, default=4,
+                    help="Split the time range into this many shards and search them concurrently")
+add_log_format_arg(parser)
 add_time_bound_args(parser)
 
 def grep(args):
-    filter_args = dict(logGroupName=args.log_group)
+    log_groups = resolve_log_groups(args.log_group)
+    filter_args = {}
     if args.log_stream:
         filter_args.update(logStreamNames=[args.log_stream])
     if args.pattern:
@@ -157,53 +191,93 @@ def grep(args):
         filter_args.update(startTime=int(timestamp(args.start_time) * 1000))
     if args.end_time:
         filter_args.update(endTime=int(timestamp(args.end_time) * 1000))
+    elif args.follow:
+        filter_args.update(endTime=int(time.time() * 1000))
+
+    def source(event):
+        return event["logGroupName"] + ":" + event["logStreamName"] if len(log_groups) > 1 else None
+
     num_results = 0
-    while True:
-        for event in paginate(clients.logs.get_paginator("filter_log_events"), **filter_args):
-            if "timestamp" not in event or "message" not in event:
-                continue
-            print(str(Timestamp(event["timestamp"])), event["message"])
+    with LogWriter(mode="ndjson" if args.json else args.format) as writer:
+        for event in filter_log_events(log_groups, shards=args.shards, **filter_args):
+            writer.write(event, source=source(event))
             num_results += 1
         if args.follow:
-            time.sleep(1)
-        else:
-            return SystemExit(os.EX_OK if num_results > 0 else os.EX_DATAERR)
+            # Followed events trickle in; write each one out as soon as it is released
+            writer.flush()
+            writer.buffer_size = 0
+            follow_args = {k: v for k, v in filter_args.items() if k not in {"startTime", "endTime"}}
+            for event in follow_log_events(log_groups, start_time=filter_args["endTime"] + 1, **follow_args):
+                writer.write(event, source=source(event))
+    return SystemExit(os.EX_OK if num_results > 0 else os.EX_DATAERR)
 
 grep_parser = register_parser(grep, help="Filter and print events in a CloudWatch Logs stream or group of streams")
 grep_parser.add_argument("pattern", help="""CloudWatch filter pattern to use. Case-sensitive. See
 http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/FilterAndPatternSyntax.html""")
-grep_parser.add_argument("log_group", help="CloudWatch log group")
+grep_parser.add_argument("log_group", help=log_group_help)
 grep_parser.add_argument("log_stream", nargs="?", help="CloudWatch log stream")
-grep_parser.add_argument("--follow", "-f", help="Repeat search continuously instead of running once",
-                         action="store_true")
+grep_parser.add_argument("--follow", "-f", action="store_true",
+                         help="After searching, continue to poll for and print new events from all log groups")
+grep_parser.add_argument("--shards", type=int, default=4,
+                         help="Split the time range into this many shards and search them concurrently")
+add_log_format_arg(grep_parser)
 add_time_bound_args(grep_parser)
 
 def clusters(args):
-    cluster_arns = sum([p["clusterArns"] for p in clients.ecs.get_paginator("list_clusters").paginate()], [])
-    page_output(tabulate(clients.ecs.describe_clusters(clusters=cluster_arns)["clusters"], args))
+    cluster_arns = list(paginate(clients.ecs.get_paginator("list_clusters")))
+
+    def describe_clusters_worker(cluster_arns):
+        return clients.ecs.describe_clusters(clusters=cluster_arns)["clusters"]
+
+    def describe_clusters():
+        with ThreadPoolExecutor() as executor:
+            for future in as_completed([executor.submit(describe_clusters_worker, chunk)
+                                        for chunk in chunked(cluster_arns, 100)]):
+                for cluster in future.result():
+                    yield cluster
+    page_output(tabulate(describe_clusters(), args))
 
 parser = register_listing_parser(clusters, help="List ECS clusters")
 
 def tasks(args):
-    cluster_arns = sum([p["clusterArns"] for p in clients.ecs.get_paginator("list_clusters").paginate()], [])
-    table = []
-    for cluster_arn in cluster_arns:
-        list_tasks_args = dict(cluster=cluster_arn, desiredStatus=args.desired_status)
-        paginator = clients.ecs.get_paginator("list_tasks")
-        task_arns = sum([p["taskArns"] for p in paginator.paginate(**list_tasks_args)], [])
-        if task_arns:
-            for task in clients.ecs.describe_tasks(cluster=cluster_arn, tasks=task_arns)["tasks"]:
-                table.append(task)
-    page_output(tabulate(table, args))
+    list_tasks = clients.ecs.get_paginator("list_tasks")
+
+    def list_tasks_worker(cluster_arn):
+        return cluster_arn, list(paginate(list_tasks, cluster=cluster_arn, desiredStatus=args.desired_status))
+
+    def describe_tasks_worker(cluster_arn, task_arns):
+        return clients.ecs.describe_tasks(cluster=cluster_arn, tasks=task_arns)["tasks"]
+
+    def describe_tasks():
+        # Task descriptions are submitted as soon as each cluster's task list arrives, and yielded as they complete
+        with ThreadPoolExecutor() as executor:
+            futures = []
+            cluster_arns = paginate(clients.ecs.get_paginator("list_clusters"))
+            for cluster_arn, task_arns in executor.map(list_tasks_worker, cluster_arns):
+                futures.extend(executor.submit(describe_tasks_worker, cluster_arn, chunk)
+                               for chunk in chunked(task_arns, 100))
+            for future in as_completed(futures):
+                for task in future.result():
+                    yield task
+    page_output(tabulate(describe_tasks(), args))
 
 parser = register_listing_parser(tasks, help="List ECS tasks")
 parser.add_argument("--desired-status", choices={"RUNNING", "PENDING", "STOPPED"}, default="RUNNING")
 
 def taskdefs(args):
-    table = []
-    for taskdef_arn in clients.ecs.list_task_definitions()["taskDefinitionArns"]:
-        table.append(clients.ecs.describe_task_definition(taskDefinition=taskdef_arn)["taskDefinition"])
-    page_output(tabulate(table, args))
+    # Task definition revisions are immutable once registered, so their descriptions are cached permanently by ARN
+    cache = JSONCache("ecs_task_definitions_cache")
+    taskdef_arns = list(paginate(clients.ecs.get_paginator("list_task_definitions")))
+
+    def describe_taskdef_worker(taskdef_arn):
+        return clients.ecs.describe_task_definition(taskDefinition=taskdef_arn)["taskDefinition"]
+
+    new_taskdef_arns = [arn for arn in taskdef_arns if arn not in cache]
+    if new_taskdef_arns:
+        with ThreadPoolExecutor() as executor:
+            cache.update(zip(new_taskdef_arns, executor.map(describe_taskdef_worker, new_taskdef_arns)))
+        cache.save()
+    page_output(tabulate([cache[arn] for arn in taskdef_arns], args))
 
 parser = register_listing_parser(taskdefs, help="List ECS task definitions",
                                  column_defaults=["family", "revision", "containerDefinitions"])
@@ -226,7 +300,7 @@ def key_pairs(args):
 parser = register_listing_parser(key_pairs, help="List EC2 SSH key pairs", column_defaults=["name", "key_fingerprint"])
 
 def subnets(args):
-    page_output(filter_and_tabulate(resources.ec2.subnets, args))
+    page_output(filter_and_tabulate(resources.ec2.subnets, args, resource_type="ec2.Subnet"))
 
 parser = register_filtering_parser(subnets, help="List EC2 VPCs and subnets")
 
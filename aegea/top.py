@@ -1,20 +1,75 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys
+import os, sys, time, collections
 from datetime import datetime
 
-from . import register_parser
+from botocore.exceptions import BotoCoreError, ClientError
+
+from . import register_parser, logger
+from .util import paginate, ThreadPoolExecutor
+from .util.aws import clients, in_region
 from .util.printing import format_table, page_output
 
+def count_paginated(paginator, expression, **kwargs):
+    # Only the projected items are counted; no resource objects are built from the pages
+    return sum(1 for _ in paginator.paginate(**kwargs).search(expression))
+
+def count_batch_jobs(status):
+    return sum(count_paginated(clients.batch.get_paginator("list_jobs"), "jobSummaryList[]",
+                               jobQueue=queue["jobQueueName"], jobStatus=status)
+               for queue in paginate(clients.batch.get_paginator("describe_job_queues")))
+
+def count_spot_requests():
+    filters = [dict(Name="state", Values=["open", "active"])]
+    return len(clients.ec2.describe_spot_instance_requests(Filters=filters)["SpotInstanceRequests"])
+
+counters = collections.OrderedDict([
+    ("Instances", lambda: count_paginated(clients.ec2.get_paginator("describe_instances"), "Reservations[].Instances[]",
+                                          PaginationConfig=dict(PageSize=1000))),
+    ("AMIs", lambda: len(clients.ec2.describe_images(Owners=["self"])["Images"])),
+    ("Volumes", lambda: count_paginated(clients.ec2.get_paginator("describe_volumes"), "Volumes[]",
+                                        PaginationConfig=dict(PageSize=500))),
+    ("Runnable jobs", lambda: count_batch_jobs("RUNNABLE")),
+    ("Running jobs", lambda: count_batch_jobs("RUNNING")),
+    ("Spot requests", count_spot_requests)
+])
+
+def count_resources(region, column):
+    with in_region(region):
+        try:
+            return counters[column]()
+        except (BotoCoreError, ClientError) as e:
+            # Some services are not available in all regions
+            logger.debug("%s: %s: %s", region, column, e)
+
 def top(args):
     import boto3
-    table = []
-    columns = ["Region", "Instances", "AMIs"]
-    for region in boto3.Session().get_available_regions("ec2"):
-        session = boto3.Session(region_name=region)
-        num_instances = len(list(session.resource("ec2").instances.all()))
-        num_amis = len(list(session.resource("ec2").images.filter(Owners=["self"])))
-        table.append([region, num_instances, num_amis])
-    page_output(format_table(table, column_names=columns, max_col_width=args.max_col_width))
+    regions = boto3.Session().get_available_regions("ec2")
+    columns = ["Region"] + list(counters)
+    counts = {region: {} for region in regions}
+    refresh_interval = {region: args.watch for region in regions}
+    next_refresh = {region: 0 for region in regions}
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        while True:
+            due = [region for region in regions if next_refresh[region] <= time.time()]
+            futures = {(region, column): executor.submit(count_resources, region, column)
+                       for region in due for column in counters}
+            for (region, column), future in futures.items():
+                counts[region][column] = future.result()
+            for region in due:
+                # Regions with nothing in them are unlikely to change, so they are refreshed less and less often
+                empty = not any(counts[region].values())
+                refresh_interval[region] = min(refresh_interval[region] * 2, args.watch * 8) if empty else args.watch
+                next_refresh[region] = time.time() + refresh_interval[region]
+            table = [[region] + [counts[region].get(column) for column in counters] for region in regions]
+            table = format_table(table, column_names=columns, max_col_width=args.max_col_width)
+            if not args.watch:
+                break
+            sys.stdout.write("\033[H\033[J" + datetime.now().strftime("%c") + "\n" + table + "\n")
+            sys.stdout.flush()
+            time.sleep(max(0, min(next_refresh.values()) - time.time()))
+    page_output(table)
 
 parser = register_parser(top, help='Show an overview of AWS resources per region')
+parser.add_argument("--watch", type=float, nargs="?", const=10, default=0, metavar="SECONDS",
+                    help="Refresh the overview in place every SECONDS (default 10)")
@@ -1,11 +1,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, re, socket, time, io, gzip
+import os, sys, re, socket, time, io, gzip, threading, concurrent.futures
 from datetime import datetime
 from dateutil.parser import parse as dateutil_parse
 from dateutil.relativedelta import relativedelta
 from .printing import GREEN
-from .compat import Repr, str
+from .compat import Repr, str, queue
 
 def wait_for_port(host, port, timeout=600, print_progress=True):
     if print_progress:
@@ -53,6 +53,74 @@ def paginate(boto3_paginator, *args, **kwargs):
             for value in page.get(result_key.parsed.get("value"), []):
                 yield value
 
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def in_current_region(fn):
+    """
+    Wrap fn so that, when it runs in another thread, it uses AWS clients and resources for the region of the thread
+    that wrapped it (see aegea.util.aws.in_region).
+    """
+    from .aws._boto3_loader import Loader
+    region = Loader.get_region()
+
+    def run_in_region(*args, **kwargs):
+        with Loader.in_region(region):
+            return fn(*args, **kwargs)
+    return run_in_region
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor whose workers make AWS API calls in the region of the thread that submitted the work.
+    """
+    def submit(self, fn, *args, **kwargs):
+        return super(ThreadPoolExecutor, self).submit(in_current_region(fn), *args, **kwargs)
+
+def prefetch(iterable, max_buffered=8):
+    """
+    Iterate over iterable in a background thread, which starts right away and keeps up to max_buffered items (or all
+    items, if max_buffered is None) ready ahead of the consumer. Exceptions raised by the iterable are re-raised in the
+    consuming thread.
+    """
+    buf, sentinel = queue.Queue(maxsize=max_buffered or 0), object()
+
+    def worker():
+        try:
+            for item in iterable:
+                buf.put((item, None))
+            buf.put((sentinel, None))
+        except Exception as e:
+            buf.put((sentinel, e))
+    thread = threading.Thread(target=in_current_region(worker))
+    thread.daemon = True
+    thread.start()
+
+    def consume():
+        while True:
+            item, error = buf.get()
+            if item is sentinel:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    return consume()
+
+class RateLimiter(object):
+    """
+    Limits the rate of calls to wait() across all threads to at most rate per second, by making callers sleep until
+    their turn.
+    """
+    def __init__(self, rate):
+        self.interval, self.next_time, self.lock = 1.0 / rate, 0, threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay, self.next_time = self.next_time - now, max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 class Timestamp(datetime):
     """
     Integer inputs are interpreted as milliseconds since the epoch. Sub-second precision is discarded. Suffixes (s, m,
@@ -1,11 +1,13 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, json, io, gzip, time
+import os, sys, json, io, gzip, time, hashlib, threading, functools, tempfile
 import requests
 from warnings import warn
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import boto3, botocore.session
+from boto3.exceptions import S3TransferFailedError, S3UploadFailedError
 from botocore.exceptions import ClientError
 from botocore.utils import parse_to_aware_datetime
 
@@ -13,7 +15,9 @@ from ... import logger
 from .. import VerboseRepr, paginate
 from ..exceptions import AegeaException
 from ..compat import str
+from ..cache import JSONCache
 from . import clients, resources
+from ._boto3_loader import Loader
 
 def get_assume_role_policy_doc(*principals):
     # See http://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_elements.html#Principal
@@ -66,6 +70,9 @@ def locate_ami(product, region=None, channel="releases", stream="released", root
     raise AegeaException("No AMI found for {} {} {} {}".format(product, region, root_store, virt))
 
 def ensure_vpc():
+    cached_vpc_id = EnsuredResources.get("vpc", "default")
+    if cached_vpc_id:
+        return resources.ec2.Vpc(cached_vpc_id)
     for vpc in resources.ec2.vpcs.filter(Filters=[dict(Name="isDefault", Values=["true"])]):
         break
     else:
@@ -84,6 +91,7 @@ def ensure_vpc():
             for route_table in vpc.route_tables.all():
                 route_table.create_route(DestinationCidrBlock="0.0.0.0/0", GatewayId=internet_gateway.id)
             ensure_subnet(vpc)
+    EnsuredResources.put("vpc", "default", vpc.id)
     return vpc
 
 def availability_zones():
@@ -91,6 +99,9 @@ def availability_zones():
         yield az["ZoneName"]
 
 def ensure_subnet(vpc):
+    cached_subnet_id = EnsuredResources.get("subnet", vpc.id)
+    if cached_subnet_id:
+        return resources.ec2.Subnet(cached_subnet_id)
     for subnet in vpc.subnets.all():
         break
     else:
@@ -104,6 +115,7 @@ def ensure_subnet(vpc):
             add_tags(subnet, Name=__name__)
             clients.ec2.modify_subnet_attribute(SubnetId=subnet.id,
                                                 MapPublicIpOnLaunch=dict(Value=config.vpc.map_public_ip_on_launch))
+    EnsuredResources.put("subnet", vpc.id, subnet.id)
     return subnet
 
 def ensure_ingress_rule(security_group, **kwargs):
@@ -126,6 +138,9 @@ def resolve_security_group(name, vpc=None):
     raise KeyError(name)
 
 def ensure_security_group(name, vpc, tcp_ingress=[dict(port=22, cidr="0.0.0.0/0")]):
+    cached_security_group = EnsuredResources.get("security_group", vpc.id + "/" + name)
+    if cached_security_group and cached_security_group["tcp_ingress"] == tcp_ingress:
+        return resources.ec2.SecurityGroup(cached_security_group["id"])
     try:
         security_group = resolve_security_group(name, vpc)
     except (ClientError, KeyError):
@@ -139,18 +154,58 @@ def ensure_security_group(name, vpc, tcp_ingress=[dict(port=22, cidr="0.0.0.0/0"
     for rule in tcp_ingress:
         ensure_ingress_rule(security_group, IpProtocol="tcp", FromPort=rule["port"], ToPort=rule["port"],
                             CidrIp=rule["cidr"])
+    EnsuredResources.put("security_group", vpc.id + "/" + name, dict(id=security_group.id, tcp_ingress=tcp_ingress))
     return security_group
 
 def ensure_s3_bucket(name=None, policy=None):
     if name is None:
         name = "aegea-assets-{}".format(ARN.get_account_id())
     bucket = resources.s3.Bucket(name)
+    policy_hash = hashlib.sha256(str(policy).encode()).hexdigest() if policy else None
+    if EnsuredResources.get("s3_bucket", name, regional=False) == dict(policy_hash=policy_hash):
+        return bucket
     bucket.create()
     bucket.wait_until_exists()
     if policy:
         bucket.Policy().put(Policy=str(policy))
+    EnsuredResources.put("s3_bucket", name, dict(policy_hash=policy_hash), regional=False)
     return bucket
 
+def upload_content_addressed(fileobj, bucket, part_size=16 * 1024 * 1024, max_concurrency=10):
+    """
+    Upload the contents of fileobj to bucket under their SHA-256 hex digest, unless an object with that key is already
+    there, and return the key. The contents are hashed in one streaming pass. If fileobj can't be rewound (a pipe), the
+    contents are spooled to a temporary file during that pass, and uploaded from there. Uploads larger than part_size
+    are split into parts that are uploaded concurrently.
+    """
+    from boto3.s3.transfer import TransferConfig
+    try:
+        start = fileobj.tell()
+        fileobj.seek(start)
+        source = fileobj
+    except (AttributeError, IOError, OSError):
+        start, source = 0, tempfile.SpooledTemporaryFile(max_size=part_size)
+    try:
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: fileobj.read(part_size), b""):
+            sha256.update(chunk)
+            if source is not fileobj:
+                source.write(chunk)
+        key = sha256.hexdigest()
+        try:
+            bucket.Object(key).load()
+            logger.debug("%s is already in %s", key, bucket.name)
+        except ClientError as e:
+            expect_error_codes(e, "404", "NoSuchKey")
+            source.seek(start)
+            transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                             max_concurrency=max_concurrency)
+            bucket.upload_fileobj(source, key, Config=transfer_config)
+    finally:
+        if source is not fileobj:
+            source.close()
+    return key
+
 def get_client_token(iam_username, service):
     from getpass import getuser
     from socket import gethostname
@@ -159,7 +214,10 @@ def get_client_token(iam_username, service):
 
 class DNSZone(VerboseRepr):
     def __init__(self, zone_name=None, use_unique_private_zone=True, create_default_private_zone=True):
-        if zone_name:
+        cached_zone = EnsuredResources.get("dns_zone", zone_name or "", regional=False)
+        if cached_zone and (zone_name or use_unique_private_zone):
+            self.zone = cached_zone
+        elif zone_name:
             self.zone = clients.route53.list_hosted_zones_by_name(DNSName=zone_name)["HostedZones"][0]
             assert self.zone["Name"].rstrip(".") == zone_name.rstrip(".")
         elif use_unique_private_zone:
@@ -183,6 +241,7 @@ class DNSZone(VerboseRepr):
                 raise AegeaException(msg.format(len(private_zones)))
         else:
             raise AegeaException("Unable to determine DNS zone to use")
+        EnsuredResources.put("dns_zone", zone_name or "", self.zone, regional=False)
         self.zone_id = os.path.basename(self.zone["Id"])
 
     def update(self, names, values, action="UPSERT", record_type="CNAME", ttl=60):
@@ -229,6 +288,8 @@ class ARN:
 
     @classmethod
     def get_region(cls):
+        if Loader.get_region() is not None:
+            return Loader.get_region()
         if cls._default_region is None:
             cls._default_region = botocore.session.Session().get_config_variable("region")
         return cls._default_region
@@ -294,19 +355,23 @@ class IAMPolicyBuilder:
         return json.dumps(self.policy)
 
 def ensure_iam_role(name, policies=frozenset(), trust=frozenset()):
-    return ensure_iam_entity(name, policies=policies, collection=resources.iam.roles,
+    return ensure_iam_entity(name, policies=policies, resource=resources.iam.Role,
                              constructor=resources.iam.create_role, RoleName=name,
                              AssumeRolePolicyDocument=get_assume_role_policy_doc(*trust))
 
 def ensure_iam_group(name, policies=frozenset()):
-    return ensure_iam_entity(name, policies=policies, collection=resources.iam.groups,
+    return ensure_iam_entity(name, policies=policies, resource=resources.iam.Group,
                              constructor=resources.iam.create_group, GroupName=name)
 
-def ensure_iam_entity(iam_entity_name, policies, collection, constructor, **constructor_args):
-    for entity in collection.all():
-        if entity.name == iam_entity_name:
-            break
-    else:
+def ensure_iam_entity(iam_entity_name, policies, resource, constructor, **constructor_args):
+    entity = resource(iam_entity_name)
+    kind, ensured_policies = "iam_" + type(entity).__name__.split(".")[-1].lower(), sorted(map(str, policies))
+    if EnsuredResources.get(kind, iam_entity_name, regional=False) == ensured_policies:
+        return entity
+    try:
+        entity.load()
+    except ClientError as e:
+        expect_error_codes(e, "NoSuchEntity")
         entity = constructor(**constructor_args)
     attached_policies = [policy.arn for policy in entity.attached_policies.all()]
     for policy in policies:
@@ -317,13 +382,18 @@ def ensure_iam_entity(iam_entity_name, policies, collection, constructor, **cons
             if policy_arn not in attached_policies:
                 entity.attach_policy(PolicyArn="arn:aws:iam::aws:policy/{}".format(policy))
     # TODO: accommodate IAM eventual consistency
+    EnsuredResources.put(kind, iam_entity_name, ensured_policies, regional=False)
     return entity
 
 def ensure_instance_profile(iam_role_name, policies=frozenset()):
-    for instance_profile in resources.iam.instance_profiles.all():
-        if instance_profile.name == iam_role_name:
-            break
-    else:
+    instance_profile = resources.iam.InstanceProfile(iam_role_name)
+    ensured_policies = sorted(map(str, policies))
+    if EnsuredResources.get("iam_instance_profile", iam_role_name, regional=False) == ensured_policies:
+        return instance_profile
+    try:
+        instance_profile.load()
+    except ClientError as e:
+        expect_error_codes(e, "NoSuchEntity")
         instance_profile = resources.iam.create_instance_profile(InstanceProfileName=iam_role_name)
         clients.iam.get_waiter("instance_profile_exists").wait(InstanceProfileName=iam_role_name)
         # IAM eventual consistency is really bad on this one
@@ -332,8 +402,128 @@ def ensure_instance_profile(iam_role_name, policies=frozenset()):
     role = ensure_iam_role(iam_role_name, policies=policies, trust=["ec2"])
     if not any(r.name == iam_role_name for r in instance_profile.roles):
         instance_profile.add_role(RoleName=role.name)
+    EnsuredResources.put("iam_instance_profile", iam_role_name, ensured_policies, regional=False)
     return instance_profile
 
+class EnsuredResources:
+    """
+    A record of the resources that ensure_vpc, ensure_iam_role and other ensure_* functions have found or created, so
+    that they can skip looking them up again. Entries are kept per account (and per region, unless regional is False)
+    in a JSONCache, and expire after config.ensured_resources_ttl_hours. Entries used by a command are invalidated if
+    the command fails with an error that suggests that they are stale (see reverify_ensured_resources_on_error).
+    """
+    cache, lock, used_keys = None, threading.RLock(), set()
+
+    @classmethod
+    def get_key(cls, kind, name, regional=True):
+        return "/".join([ARN.get_account_id(), ARN.get_region() if regional else "", kind, name])
+
+    @classmethod
+    def get_cache(cls):
+        if cls.cache is None:
+            cls.cache = JSONCache("ensured_resources_cache")
+        return cls.cache
+
+    @classmethod
+    def get(cls, kind, name, regional=True):
+        from ... import config
+        key = cls.get_key(kind, name, regional=regional)
+        with cls.lock:
+            entry = cls.get_cache().get(key)
+            if entry and time.time() - entry["verified_at"] < config.ensured_resources_ttl_hours * 3600:
+                cls.used_keys.add(key)
+                return entry["value"]
+
+    @classmethod
+    def put(cls, kind, name, value, regional=True):
+        key = cls.get_key(kind, name, regional=regional)
+        with cls.lock:
+            cls.get_cache()[key] = dict(value=value, verified_at=time.time())
+            cls.get_cache().save()
+        return value
+
+    @classmethod
+    def invalidate(cls, keys=None):
+        """
+        Forget the given entries, or all cached entries used by this process if keys is None.
+        """
+        with cls.lock:
+            for key in list(cls.used_keys if keys is None else keys):
+                cls.get_cache().pop(key, None)
+                cls.used_keys.discard(key)
+            cls.get_cache().save()
+
+    @classmethod
+    @contextmanager
+    def verify_on_error(cls):
+        """
+        Wraps API calls (and S3 transfers) that depend on ensured resources. If such a call fails with an error in
+        stale_resource_error_codes after cached entries were used, the entries are invalidated and the error is raised
+        as StaleEnsuredResources, so that reverify_ensured_resources_on_error can retry the command.
+        """
+        try:
+            yield
+        except (ClientError, S3TransferFailedError, S3UploadFailedError) as e:
+            if cls.used_keys and cls.is_stale_resource_error(e):
+                cls.invalidate()
+                raise StaleEnsuredResources(e)
+            raise
+
+    @classmethod
+    def is_stale_resource_error(cls, error):
+        """
+        Return True if the error says that a resource does not exist. Batch reports all client errors as
+        ClientException, so those only count if the message names one of the cached entries used by this process. S3
+        transfer errors don't carry the error response, so their message is searched for the error code instead.
+        """
+        if not isinstance(error, ClientError):
+            return any("({})".format(code) in str(error) for code in stale_resource_error_codes)
+        code, message = error.response["Error"]["Code"], error.response["Error"].get("Message", "")
+        if code in stale_resource_error_codes:
+            return True
+        if code != "ClientException":
+            return False
+        with cls.lock:
+            identifiers = set()
+            for key in cls.used_keys:
+                identifiers.update(key.split("/", 3)[-1].split("/"))
+                value = cls.get_cache().get(key, {}).get("value")
+                if isinstance(value, dict):
+                    value = value.get("id")
+                if isinstance(value, str):
+                    identifiers.add(value)
+        return any(i not in {"", "default"} and i in message for i in identifiers)
+
+class StaleEnsuredResources(AegeaException):
+    pass
+
+# Error codes that AWS APIs return when a resource they were passed (a subnet, security group, IAM role or instance
+# profile, bucket or log group) no longer exists
+stale_resource_error_codes = {"InvalidVpcID.NotFound", "InvalidSubnetID.NotFound", "InvalidGroup.NotFound",
+                              "NoSuchEntity", "NoSuchBucket", "ResourceNotFoundException"}
+
+def reverify_ensured_resources_on_error(fn):
+    """
+    Decorates a command function (taking parsed args) that uses ensure_* functions. If a call wrapped in
+    EnsuredResources.verify_on_error() finds that cached ensured resources are stale, the command is run once more with
+    a fresh copy of its arguments, which verifies (and if needed recreates) the resources.
+    """
+    @functools.wraps(fn)
+    def wrapper(args):
+        retry_args = type(args)(**{k: v[:] if isinstance(v, list) else v for k, v in vars(args).items()})
+        EnsuredResources.used_keys.clear()
+        try:
+            return fn(args)
+        except StaleEnsuredResources as e:
+            logger.warn("%s. Verifying the resources used and retrying", e)
+            for value in vars(retry_args).values():
+                try:
+                    value.seek(0)
+                except (AttributeError, IOError, OSError):
+                    pass
+            return fn(retry_args)
+    return wrapper
+
 def encode_tags(tags):
     if isinstance(tags, (list, tuple)):
         tags = dict(tag.split("=", 1) for tag in tags)
@@ -348,6 +538,17 @@ def add_tags(resource, dry_run=False, **tags):
 def filter_by_tags(collection, **tags):
     return collection.filter(Filters=[dict(Name="tag:" + k, Values=[v]) for k, v in tags.items()])
 
+in_region = Loader.in_region
+in_own_session = Loader.in_own_session
+
+def resolve_regions(regions):
+    """
+    Expand a comma-separated list of region names, or "all" for all EC2 regions, into a list of region names.
+    """
+    if regions == "all":
+        return boto3.Session().get_available_regions("ec2")
+    return regions.split(",")
+
 def resolve_instance_id(name):
     filter_name = "dns-name" if name.startswith("ec2") and name.endswith("compute.amazonaws.com") else "tag:Name"
     if name.startswith("i-"):
@@ -489,14 +690,18 @@ def resolve_log_group(name):
         raise AegeaException("Log group {} not found".format(name))
 
 def ensure_log_group(name):
+    log_group = EnsuredResources.get("log_group", name)
+    if log_group:
+        return log_group
     try:
-        return resolve_log_group(name)
+        log_group = resolve_log_group(name)
     except AegeaException:
         try:
             clients.logs.create_log_group(logGroupName=name)
         except clients.logs.exceptions.ResourceAlreadyExistsException:
             pass
-        return resolve_log_group(name)
+        log_group = resolve_log_group(name)
+    return EnsuredResources.put("log_group", name, log_group)
 
 def get_cloudwatch_metric_stats(namespace, name, start_time=None, end_time=None, period=None, statistic="Average",
                                 resource=None, **kwargs):
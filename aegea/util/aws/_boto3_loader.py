@@ -1,5 +1,13 @@
+import threading
+from contextlib import contextmanager
+
 class Loader:
     cache = dict(resource={}, client={})
+    # Clients and resources for regions other than the default one, each created from a session for that region
+    region_caches = {}
+    # boto3's default session is not thread-safe, so client and resource construction is serialized
+    lock = threading.RLock()
+    local = threading.local()
 
     def __init__(self, factory):
         self.factory = factory
@@ -9,11 +17,68 @@ class Loader:
             return list(self.cache[self.factory])
         if attr == "__path__" or attr == "__loader__":
             return None
-        if attr not in self.cache[self.factory]:
-            if self.factory == "client" and attr in self.cache["resource"]:
-                self.cache["client"][attr] = self.cache["resource"][attr].meta.client
-            else:
-                import boto3
-                factory = getattr(boto3, self.factory)
-                self.cache[self.factory][attr] = factory(attr)
-        return self.cache[self.factory][attr]
+        cache = self.get_cache(self.factory)
+        if attr not in cache[self.factory] and cache is getattr(self.local, "session_cache", None):
+            # Sessions created by in_own_session are used by one thread only, so they need no locking
+            cache[self.factory][attr] = self.create(attr, cache)
+        elif attr not in cache[self.factory]:
+            with self.lock:
+                if attr not in cache[self.factory]:
+                    cache[self.factory][attr] = self.create(attr, cache)
+        return cache[self.factory][attr]
+
+    def create(self, attr, cache):
+        if self.factory == "client" and attr in cache["resource"]:
+            return cache["resource"][attr].meta.client
+        import boto3
+        return getattr(cache.get("session", boto3), self.factory)(attr)
+
+    @classmethod
+    def get_region(cls):
+        return getattr(cls.local, "region", None)
+
+    @classmethod
+    def get_cache(cls, factory=None):
+        region = cls.get_region()
+        session_cache = getattr(cls.local, "session_cache", None)
+        if factory == "resource" and session_cache is not None and session_cache["region"] == region:
+            return session_cache
+        if region is None:
+            return cls.cache
+        if region not in cls.region_caches:
+            with cls.lock:
+                if region not in cls.region_caches:
+                    import boto3
+                    cls.region_caches[region] = dict(resource={}, client={}, session=boto3.Session(region_name=region))
+        return cls.region_caches[region]
+
+    @classmethod
+    @contextmanager
+    def in_region(cls, region):
+        """
+        While this context manager is active, clients and resources accessed by the current thread are bound to the
+        given region. A region of None selects the default region.
+        """
+        previous_region, cls.local.region = cls.get_region(), region
+        try:
+            yield
+        finally:
+            cls.local.region = previous_region
+
+    @classmethod
+    @contextmanager
+    def in_own_session(cls):
+        """
+        While this context manager is active, resources accessed by the current thread come from a session of its own,
+        bound to the thread's current region. Unlike clients, boto3 resources are not thread-safe, so worker threads
+        that use them should not share them with other threads.
+        """
+        import boto3
+        previous_session_cache = getattr(cls.local, "session_cache", None)
+        with cls.lock:
+            session = boto3.Session(region_name=cls.get_region())
+        cls.local.session_cache = dict(resource={}, client={}, session=session, region=cls.get_region())
+        try:
+            yield
+        finally:
+            cls.local.session_cache = previous_session_cache
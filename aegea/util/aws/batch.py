@@ -0,0 +1,293 @@
+"""
+Helpers for listing and describing AWS Batch jobs, a local store of job descriptions, and an archive of final job
+descriptions in S3.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, io, json, time, gzip, uuid, sqlite3, itertools
+from datetime import datetime, timedelta
+
+from ... import logger
+from .. import chunked, paginate, ThreadPoolExecutor
+from . import ARN, clients
+
+terminal_job_states = {"SUCCEEDED", "FAILED"}
+
+def list_jobs(job_queue, job_status, stop_at=frozenset(), array_job_id=None):
+    """
+    Return the summaries of all jobs in the given queue with the given status, following nextToken through all pages
+    of results. The queue name and status are added to each summary. If stop_at is given, paging stops after the first
+    page that contains any of the job IDs in it. If array_job_id is given, the children of that array job are listed
+    instead of the jobs in the queue.
+    """
+    list_args, job_summaries = dict(jobStatus=job_status), []
+    list_args.update(dict(arrayJobId=array_job_id) if array_job_id else dict(jobQueue=job_queue))
+    while True:
+        page = clients.batch.list_jobs(**list_args)
+        for job_summary in page["jobSummaryList"]:
+            if job_queue is not None:
+                job_summary.setdefault("jobQueue", job_queue)
+            job_summary.setdefault("status", job_status)
+            job_summaries.append(job_summary)
+        if not page.get("nextToken") or any(j["jobId"] in stop_at for j in page["jobSummaryList"]):
+            return job_summaries
+        list_args["nextToken"] = page["nextToken"]
+
+def list_all_jobs(job_queues, job_statuses, max_workers=16, stop_at=frozenset()):
+    """
+    Return the summaries of all jobs in the given queues with any of the given statuses. Each queue and status pair is
+    listed concurrently. Listings of jobs in terminal states stop early at the job IDs in stop_at (see list_jobs).
+    """
+    def list_jobs_worker(args):
+        job_queue, job_status = args
+        return list_jobs(job_queue, job_status, stop_at=stop_at if job_status in terminal_job_states else frozenset())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(list_jobs_worker, itertools.product(job_queues, job_statuses))
+        return [job_summary for page in pages for job_summary in page]
+
+def list_array_job_children(array_job_id, job_statuses, max_workers=8):
+    """
+    Return the summaries of all children of the given array job with any of the given statuses, listing each status
+    concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(lambda status: list_jobs(None, status, array_job_id=array_job_id), job_statuses)
+        return [job_summary for page in pages for job_summary in page]
+
+def get_array_status_summary(job_desc):
+    """
+    Return a dict of the number of child jobs in each status for an array job description, or None if the job is not
+    the parent of an array job. Child jobs have an array index instead of a status summary.
+    """
+    array_properties = job_desc.get("arrayProperties", {})
+    if "index" in array_properties or "size" not in array_properties:
+        return None
+    return {status: n for status, n in array_properties.get("statusSummary", {}).items() if n}
+
+def describe_jobs(job_ids, max_workers=8):
+    """
+    Describe the given jobs, in concurrent requests of up to 100 job IDs each (the DescribeJobs limit).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(lambda chunk: clients.batch.describe_jobs(jobs=chunk)["jobs"], chunked(job_ids, 100))
+        return [job for page in pages for job in page]
+
+def get_job_queue_names():
+    return [q["jobQueueName"] for q in paginate(clients.batch.get_paginator("describe_job_queues"))]
+
+class JobArchive(object):
+    """
+    An append-only archive of final job descriptions in S3. Each append writes one segment, a gzipped NDJSON file named
+    job_archive/<region>/<date>/<time>-<random>.ndjson.gz, so segment keys sort in the order they were started. A
+    segment may appear up to max_write_lag seconds after segments with later keys, since its upload takes time.
+    """
+    key_format = "{:%Y-%m-%d/%Y%m%dT%H%M%S}"
+    max_write_lag = 900
+
+    def __init__(self, bucket_name=None, region=None):
+        self._bucket_name, self.region = bucket_name, region or ARN.get_region()
+        self.prefix = "job_archive/{}/".format(self.region)
+
+    @property
+    def bucket_name(self):
+        if self._bucket_name is None:
+            from . import ensure_s3_bucket
+            self._bucket_name = ensure_s3_bucket("aegea-batch-jobs-{}".format(ARN.get_account_id())).name
+        return self._bucket_name
+
+    def with_bucket(self, fn):
+        """
+        Call fn with the name of the archive bucket. If the bucket came from the ensured resources cache and no longer
+        exists, it is ensured again and fn is called once more.
+        """
+        from . import EnsuredResources, StaleEnsuredResources
+        try:
+            with EnsuredResources.verify_on_error():
+                return fn(self.bucket_name)
+        except StaleEnsuredResources as e:
+            logger.warn("%s. Verifying the job archive bucket and retrying", e)
+            self._bucket_name = None
+            return fn(self.bucket_name)
+
+    def append(self, jobs):
+        key = self.prefix + self.key_format.format(datetime.utcnow()) + "-{}.ndjson.gz".format(uuid.uuid4().hex)
+        with io.BytesIO() as buf:
+            with gzip.GzipFile(fileobj=buf, mode="wb") as fh:
+                fh.write("".join(json.dumps(job) + "\n" for job in jobs).encode("utf-8"))
+            self.with_bucket(lambda bucket_name: clients.s3.put_object(Bucket=bucket_name, Key=key,
+                                                                       Body=buf.getvalue()))
+        return key
+
+    def list_segments(self, start_after=None):
+        """
+        List the keys of the segments after start_after. Keys up to max_write_lag seconds older than start_after are
+        listed too, since those segments may have appeared after start_after was listed.
+        """
+        list_args = dict(Prefix=self.prefix)
+        if start_after:
+            written_at = datetime.strptime(start_after[len(self.prefix):].split("/")[1][:15], "%Y%m%dT%H%M%S")
+            written_at -= timedelta(seconds=self.max_write_lag)
+            list_args.update(StartAfter=self.prefix + self.key_format.format(written_at))
+        return self.with_bucket(lambda bucket_name: [o["Key"] for o in paginate(
+            clients.s3.get_paginator("list_objects_v2"), Bucket=bucket_name, **list_args)])
+
+    def read_segment(self, key):
+        body = clients.s3.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as fh:
+            return [json.loads(line) for line in fh.read().decode("utf-8").splitlines() if line]
+
+class JobStore(object):
+    """
+    A local SQLite store of Batch job descriptions, kept in the aegea user config directory. Batch forgets jobs about
+    24 hours after they finish; descriptions of jobs in terminal states never change, so they are kept here
+    permanently and never requested again. Jobs in other states are re-described whenever they are needed.
+
+    If a JobArchive is given, jobs that are seen reaching a terminal state are also appended to it, and jobs that are
+    neither in the store nor known to Batch any more are looked for in the archive segments not yet loaded into the
+    store.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY, region TEXT NOT NULL, job_queue TEXT NOT NULL, status TEXT NOT NULL,
+        created_at INTEGER, updated_at REAL NOT NULL, data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_by_queue_and_status ON jobs (region, job_queue, status, created_at);
+    CREATE TABLE IF NOT EXISTS archived_jobs (job_id TEXT PRIMARY KEY, segment_key TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS archive_segments (segment_key TEXT PRIMARY KEY, region TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS archive_sync (region TEXT PRIMARY KEY, last_listed_segment_key TEXT NOT NULL);
+    """
+
+    def __init__(self, filename=None, archive=None):
+        if filename is None:
+            from ... import config
+            filename = os.path.join(config.user_config_dir, "batch_jobs.db")
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.schema)
+        self.region = ARN.get_region()
+        self.archive = archive
+
+    def save(self, jobs):
+        rows = [(job["jobId"], self.region, job["jobQueue"].split("/")[-1], job["status"], job.get("createdAt"),
+                 time.time(), json.dumps(job)) for job in jobs]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, job_ids):
+        """
+        Return a dict of the stored descriptions of any of the given jobs, keyed by job ID.
+        """
+        jobs = {}
+        for chunk in chunked(list(job_ids), 500):
+            sql = "SELECT job_id, data FROM jobs WHERE job_id IN ({})".format(", ".join("?" * len(chunk)))
+            jobs.update((job_id, json.loads(data)) for job_id, data in self.db.execute(sql, chunk))
+        return jobs
+
+    def query(self, job_queues, job_statuses, created_after=None):
+        sql = "SELECT data FROM jobs WHERE region=? AND job_queue IN ({}) AND status IN ({})"
+        sql = sql.format(", ".join("?" * len(job_queues)), ", ".join("?" * len(job_statuses)))
+        params = [self.region] + list(job_queues) + list(job_statuses)
+        if created_after is not None:
+            sql += " AND created_at >= ?"
+            params.append(created_after)
+        return [json.loads(data) for data, in self.db.execute(sql + " ORDER BY created_at", params)]
+
+    def describe(self, job_ids):
+        """
+        Describe the given jobs. Jobs stored in terminal states are not requested from Batch. The other jobs are
+        described by Batch and stored; jobs that Batch no longer knows about are taken from the store if present.
+        """
+        jobs = self.get(job_ids)
+        to_describe = [job_id for job_id in job_ids if jobs.get(job_id, {}).get("status") not in terminal_job_states]
+        described = describe_jobs(to_describe) if to_describe else []
+        self.save(described)
+        self.archive_jobs([job for job in described if job["status"] in terminal_job_states])
+        jobs.update((job["jobId"], job) for job in described)
+        if self.archive is not None and any(job_id not in jobs for job_id in job_ids):
+            self.sync_archive()
+            jobs.update(self.get([job_id for job_id in job_ids if job_id not in jobs]))
+        return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+    def record_segment(self, segment_key, jobs):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO archived_jobs VALUES (?, ?)",
+                                [(job["jobId"], segment_key) for job in jobs])
+            self.db.execute("INSERT OR IGNORE INTO archive_segments VALUES (?, ?)", (segment_key, self.region))
+
+    def archive_jobs(self, jobs):
+        """
+        Append the jobs that are not yet archived to the archive, as one segment. Failures are logged and ignored, since
+        the jobs remain in the store.
+        """
+        if self.archive is None or not jobs:
+            return
+        archived = set(job_id for job_id, in self.db.execute(
+            "SELECT job_id FROM archived_jobs WHERE job_id IN ({})".format(", ".join("?" * len(jobs))),
+            [job["jobId"] for job in jobs]))
+        jobs = [job for job in jobs if job["jobId"] not in archived]
+        if jobs:
+            try:
+                self.record_segment(self.archive.append(jobs), jobs)
+            except Exception as e:
+                logger.warn("Unable to archive descriptions of %d jobs: %s", len(jobs), e)
+
+    def archive_stored_jobs(self, segment_size=10000):
+        """
+        Append the stored jobs in terminal states that are not yet archived to the archive, in segments of up to
+        segment_size jobs. Returns the number of jobs archived.
+        """
+        sql = ("SELECT data FROM jobs WHERE region=? AND status IN ({})"
+               " AND job_id NOT IN (SELECT job_id FROM archived_jobs) ORDER BY created_at")
+        sql = sql.format(", ".join("?" * len(terminal_job_states)))
+        jobs = [json.loads(data) for data, in self.db.execute(sql, [self.region] + sorted(terminal_job_states))]
+        for chunk in chunked(jobs, segment_size):
+            self.record_segment(self.archive.append(chunk), chunk)
+        return len(jobs)
+
+    def sync_archive(self, max_workers=8):
+        """
+        Load the archive segments that were not yet listed by a previous sync, skipping segments already recorded
+        (including those appended by this store). Returns the number of jobs loaded.
+
+        The last segment key listed is kept separately from the recorded segments: this store's own appends may have
+        later keys than segments that other hosts have written but this store has not yet listed.
+        """
+        row = self.db.execute("SELECT last_listed_segment_key FROM archive_sync WHERE region=?",
+                              (self.region,)).fetchone()
+        listed_keys = self.archive.list_segments(start_after=row[0] if row else None)
+        recorded_keys = set()
+        for chunk in chunked(listed_keys, 500):
+            sql = "SELECT segment_key FROM archive_segments WHERE segment_key IN ({})"
+            recorded_keys.update(key for key, in self.db.execute(sql.format(", ".join("?" * len(chunk))), chunk))
+        segment_keys = [key for key in listed_keys if key not in recorded_keys]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            segments = list(executor.map(self.archive.read_segment, segment_keys))
+        for segment_key, jobs in zip(segment_keys, segments):
+            self.save(jobs)
+            self.record_segment(segment_key, jobs)
+        if listed_keys:
+            last_listed_key = max(listed_keys + ([row[0]] if row else []))
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO archive_sync VALUES (?, ?)", (self.region, last_listed_key))
+        return sum(len(jobs) for jobs in segments)
+
+    def list_jobs(self, job_queues, job_statuses, created_after=None):
+        """
+        List jobs in the given queues with any of the given statuses. Jobs in non-terminal states are listed from Batch
+        as job summaries. Jobs in terminal states are listed from Batch only until a job already in the store is
+        reached; the stored descriptions are returned for the rest. If created_after (milliseconds since the epoch) is
+        given, jobs in terminal states that were created before it are left out.
+        """
+        terminal_statuses = [status for status in job_statuses if status in terminal_job_states]
+        stored_jobs = []
+        if terminal_statuses:
+            stored_jobs = self.query(job_queues, terminal_statuses, created_after=created_after)
+        stored_job_ids = {job["jobId"] for job in stored_jobs}
+        job_summaries = [job for job in list_all_jobs(job_queues, job_statuses, stop_at=stored_job_ids)
+                         if job["jobId"] not in stored_job_ids]
+        if created_after is not None:
+            job_summaries = [job for job in job_summaries
+                             if job["status"] not in terminal_job_states or job.get("createdAt", 0) >= created_after]
+        return job_summaries + stored_jobs
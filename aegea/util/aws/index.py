@@ -0,0 +1,250 @@
+"""
+A local SQLite index of AWS resources.
+
+``ResourceIndex.sync()`` snapshots the resource types listed in ``indexed_types`` into a database in the aegea user
+config directory. Each resource is stored as its JSON description, with the fields that listings filter and sort on
+most often (ID, name, state, creation time and tags) broken out into indexed columns, so that ``--offline`` listings
+are answered with SQL-level filter, sort and limit without calling any AWS APIs.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, re, json, time, sqlite3, collections
+from datetime import datetime
+
+import boto3
+from botocore import xform_name
+from dateutil.tz import tzutc
+
+from ... import logger
+from .. import paginate, chunked, ThreadPoolExecutor
+from ..exceptions import AegeaException
+from ..compat import str
+from ..cache import parse_timestamp
+from . import ARN, clients, resources, in_own_session
+from .batch import list_all_jobs, describe_jobs, get_job_queue_names
+
+def get_tag(tags, key):
+    for tag in tags or []:
+        if tag["Key"] == key:
+            return tag["Value"]
+
+def fetch_ec2(collection_name, **params):
+    def fetch():
+        return [r.meta.data for r in getattr(resources.ec2, collection_name).filter(**params)]
+    return fetch
+
+def fetch_snapshots():
+    return [s.meta.data for s in resources.ec2.snapshots.filter(OwnerIds=[ARN.get_account_id()])]
+
+def fetch_ecs_tasks():
+    tasks = []
+    for cluster_arn in paginate(clients.ecs.get_paginator("list_clusters")):
+        for status in "RUNNING", "STOPPED":
+            task_arns = list(paginate(clients.ecs.get_paginator("list_tasks"), cluster=cluster_arn,
+                                      desiredStatus=status))
+            for chunk in chunked(task_arns, 100):
+                tasks.extend(clients.ecs.describe_tasks(cluster=cluster_arn, tasks=chunk)["tasks"])
+    return tasks
+
+def fetch_batch_jobs():
+    job_statuses = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING", "SUCCEEDED", "FAILED"]
+    return describe_jobs([job["jobId"] for job in list_all_jobs(get_job_queue_names(), job_statuses)])
+
+def fetch_log_groups():
+    return list(paginate(clients.logs.get_paginator("describe_log_groups")))
+
+def fetch_dns_records():
+    records = []
+    for zone in paginate(clients.route53.get_paginator("list_hosted_zones")):
+        for record in paginate(clients.route53.get_paginator("list_resource_record_sets"), HostedZoneId=zone["Id"]):
+            record["HostedZoneId"] = zone["Id"].split("/")[-1]
+            records.append(record)
+    return records
+
+def dns_record_id(record):
+    return "/".join([record["HostedZoneId"], record["Name"], record["Type"], record.get("SetIdentifier", "")])
+
+IndexedType = collections.namedtuple("IndexedType", "fetch get_id get_name get_state get_created_at get_tags")
+
+def get_ec2_name(resource):
+    return get_tag(resource.get("Tags"), "Name") or resource.get("Name") or resource.get("GroupName")
+
+def ec2_type(fetch, id_key, created_at_key=None, get_state=lambda r: r.get("State")):
+    return IndexedType(fetch, lambda r: r[id_key], get_ec2_name,
+                       get_state, lambda r: r.get(created_at_key), lambda r: r.get("Tags") or [])
+
+indexed_types = collections.OrderedDict([
+    ("ec2.Instance", ec2_type(fetch_ec2("instances"), "InstanceId", "LaunchTime", lambda r: r["State"]["Name"])),
+    ("ec2.Volume", ec2_type(fetch_ec2("volumes"), "VolumeId", "CreateTime")),
+    ("ec2.Snapshot", ec2_type(fetch_snapshots, "SnapshotId", "StartTime")),
+    ("ec2.Image", ec2_type(fetch_ec2("images", Owners=["self"]), "ImageId", "CreationDate")),
+    ("ec2.SecurityGroup", ec2_type(fetch_ec2("security_groups"), "GroupId", get_state=lambda r: None)),
+    ("ec2.Subnet", ec2_type(fetch_ec2("subnets"), "SubnetId")),
+    ("ecs.Task", IndexedType(fetch_ecs_tasks, lambda r: r["taskArn"], lambda r: r["taskDefinitionArn"].split("/")[-1],
+                             lambda r: r.get("lastStatus"), lambda r: r.get("createdAt"), lambda r: [])),
+    ("batch.Job", IndexedType(fetch_batch_jobs, lambda r: r["jobId"], lambda r: r["jobName"], lambda r: r["status"],
+                              lambda r: r.get("createdAt"), lambda r: [])),
+    ("logs.LogGroup", IndexedType(fetch_log_groups, lambda r: r["logGroupName"], lambda r: r["logGroupName"],
+                                  lambda r: None, lambda r: r.get("creationTime"), lambda r: [])),
+    ("route53.ResourceRecordSet", IndexedType(fetch_dns_records, dns_record_id, lambda r: r["Name"],
+                                              lambda r: None, lambda r: None, lambda r: []))
+])
+
+# Filter and sort names that map to indexed columns rather than to fields of the JSON description
+indexed_columns = {"id": "id", "name": "name", "state": "state", "instance-state-name": "state",
+                   "created_at": "created_at"}
+
+def filter_name_to_json_path(name):
+    # Filter and sort names use the EC2 API filter (instance-type) or boto3 attribute (instance_type) spelling
+    return "$." + "".join(word[:1].upper() + word[1:] for word in re.split("[-_]", name))
+
+def to_sql_value(value):
+    return {"true": "1", "false": "0"}.get(value, value)
+
+class OfflineResource(object):
+    """
+    A read-only stand-in for a boto3 resource, built from the JSON description stored in the index. Attributes use
+    the boto3 snake_case spelling of the description's keys; attributes absent from the description are None.
+    """
+    def __init__(self, resource_type, resource_id, data):
+        self.id, self.meta = resource_id, collections.namedtuple("ResourceMeta", "data")(data)
+        self._resource_type = resource_type
+        self._attrs = {xform_name(k): parse_timestamp(v) for k, v in data.items()}
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return self._attrs.get(attr)
+
+    def __repr__(self):
+        return "{}(id={!r}) [offline]".format(self._resource_type, self.id)
+
+class ResourceIndex(object):
+    schema = """
+    CREATE TABLE IF NOT EXISTS resources (
+        type TEXT NOT NULL, account_id TEXT NOT NULL, region TEXT NOT NULL, id TEXT NOT NULL,
+        name TEXT, state TEXT, created_at TEXT, data TEXT NOT NULL,
+        PRIMARY KEY (type, account_id, region, id)
+    );
+    CREATE INDEX IF NOT EXISTS resources_by_name ON resources (type, account_id, region, name);
+    CREATE INDEX IF NOT EXISTS resources_by_state ON resources (type, account_id, region, state);
+    CREATE INDEX IF NOT EXISTS resources_by_created_at ON resources (type, account_id, region, created_at);
+    CREATE TABLE IF NOT EXISTS tags (
+        type TEXT NOT NULL, account_id TEXT NOT NULL, region TEXT NOT NULL, id TEXT NOT NULL,
+        key TEXT NOT NULL, value TEXT,
+        PRIMARY KEY (type, account_id, region, id, key)
+    );
+    CREATE INDEX IF NOT EXISTS tags_by_key_value ON tags (type, account_id, region, key, value);
+    CREATE TABLE IF NOT EXISTS syncs (
+        profile TEXT NOT NULL, region TEXT NOT NULL, type TEXT NOT NULL, account_id TEXT NOT NULL,
+        count INTEGER NOT NULL, synced_at REAL NOT NULL,
+        PRIMARY KEY (profile, region, type)
+    );
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            from ... import config
+            filename = os.path.join(config.user_config_dir, "index.db")
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.schema)
+        self.profile = boto3.Session().profile_name or "default"
+        self.region = ARN.get_region()
+
+    def sync(self, types=None, max_workers=8):
+        """
+        Fetch the current state of each of the given resource types (all indexed types by default) concurrently, and
+        replace the indexed snapshot of each type with it. Returns a dict of resource counts by type.
+        """
+        types = list(types or indexed_types)
+        for resource_type in types:
+            if resource_type not in indexed_types:
+                raise AegeaException("Unknown resource type {}. Indexed types are: {}".format(
+                    resource_type, ", ".join(indexed_types)))
+        account_id, counts = ARN.get_account_id(), {}
+
+        def fetch(resource_type):
+            with in_own_session():
+                return indexed_types[resource_type].fetch()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for resource_type, items in zip(types, executor.map(fetch, types)):
+                self.save(resource_type, account_id, items)
+                counts[resource_type] = len(items)
+                logger.info("Indexed %d %s resources", len(items), resource_type)
+        return counts
+
+    def save(self, resource_type, account_id, items):
+        t, key = indexed_types[resource_type], (resource_type, account_id, self.region)
+        rows, tag_rows = [], []
+        for item in items:
+            resource_id, created_at = t.get_id(item), t.get_created_at(item)
+            rows.append(key + (resource_id, t.get_name(item), t.get_state(item),
+                               None if created_at is None else str(created_at), json.dumps(item, default=str)))
+            tag_rows.extend(key + (resource_id, tag["Key"], tag["Value"]) for tag in t.get_tags(item))
+        with self.db:
+            for table in "resources", "tags":
+                self.db.execute("DELETE FROM {} WHERE type=? AND account_id=? AND region=?".format(table), key)
+            self.db.executemany("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)", tag_rows)
+            self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?, ?)",
+                            (self.profile, self.region, resource_type, account_id, len(items), time.time()))
+
+    def get_sync(self, resource_type):
+        # The account ID is looked up from the last sync of this profile and region, so that queries stay offline
+        cursor = self.db.execute("SELECT account_id, synced_at FROM syncs WHERE profile=? AND region=? AND type=?",
+                                 (self.profile, self.region, resource_type))
+        return cursor.fetchone()
+
+    def status(self):
+        cursor = self.db.execute("SELECT type, account_id, count, synced_at FROM syncs WHERE profile=? AND region=?",
+                                 (self.profile, self.region))
+        return [dict(type=resource_type, account_id=account_id, count=count,
+                     synced_at=datetime.fromtimestamp(synced_at, tzutc()))
+                for resource_type, account_id, count, synced_at in cursor]
+
+    def query(self, resource_type, filters=(), tags=(), sort_by=None, limit=None):
+        """
+        Return indexed resources of the given type, as dicts with the indexed columns (id, name, state, created_at)
+        and the JSON description (data) of each resource. Filters and tags are lists of (name, value) pairs that must
+        all match. Names that correspond to indexed columns (id, name, state) are matched against those columns, and
+        other names are matched against the JSON description. Sort keys follow the same rules, and may end in
+        ":reverse" to sort in descending order.
+        """
+        if resource_type not in indexed_types:
+            raise AegeaException("{} resources are not indexed, so they cannot be listed offline".format(resource_type))
+        sync = self.get_sync(resource_type)
+        if sync is None:
+            raise AegeaException('No {} resources have been indexed in {} yet. Run "aegea index sync" first'.format(
+                resource_type, self.region))
+        logger.info("Using %s index from %s", resource_type, time.ctime(sync[1]))
+        sql = "SELECT id, name, state, created_at, data FROM resources r WHERE type=? AND account_id=? AND region=?"
+        params = [resource_type, sync[0], self.region]
+        for name, value in filters:
+            if name in indexed_columns:
+                sql += " AND {}=?".format(indexed_columns[name])
+                params.append(value)
+            else:
+                sql += " AND CAST(json_extract(data, ?) AS TEXT)=?"
+                params.extend([filter_name_to_json_path(name), to_sql_value(value)])
+        for name, value in tags:
+            sql += (" AND EXISTS (SELECT 1 FROM tags t WHERE t.type=r.type AND t.account_id=r.account_id"
+                    " AND t.region=r.region AND t.id=r.id AND t.key=? AND t.value=?)")
+            params.extend([name, value])
+        if sort_by:
+            reverse = sort_by.endswith(":reverse")
+            name = sort_by[:-len(":reverse")] if reverse else sort_by
+            if name in indexed_columns:
+                sql += " ORDER BY {}".format(indexed_columns[name])
+            else:
+                sql += " ORDER BY json_extract(data, ?)"
+                params.append(filter_name_to_json_path(name))
+            sql += " DESC" if reverse else ""
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [dict(id=row[0], name=row[1], state=row[2], created_at=parse_timestamp(row[3]), data=json.loads(row[4]))
+                for row in self.db.execute(sql, params)]
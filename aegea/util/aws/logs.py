@@ -0,0 +1,185 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys, json, time, heapq, itertools, threading
+
+from .. import paginate, prefetch, ThreadPoolExecutor
+from ..compat import USING_PYTHON2
+from ..exceptions import AegeaException
+from . import clients
+
+def resolve_log_groups(names):
+    """
+    Expand a comma-separated list of log group names into a list of log group names. Names ending in "*" are treated
+    as prefixes and expanded to all log groups that match them. Raises AegeaException if no log groups match.
+    """
+    log_groups = []
+    for name in names.split(","):
+        if name.endswith("*"):
+            paginator = clients.logs.get_paginator("describe_log_groups")
+            matches = [g["logGroupName"] for g in paginate(paginator, logGroupNamePrefix=name[:-1])]
+        else:
+            matches = [name]
+        log_groups.extend(g for g in matches if g not in log_groups)
+    if not log_groups:
+        raise AegeaException("No log groups match {}".format(names))
+    return log_groups
+
+def split_time_range(start_time, end_time, num_shards):
+    """
+    Split the inclusive range [start_time, end_time] (milliseconds since the epoch) into at most num_shards contiguous,
+    non-overlapping inclusive ranges of roughly equal length.
+    """
+    num_shards = max(1, min(num_shards, end_time - start_time + 1))
+    bounds = [start_time + (end_time - start_time + 1) * i // num_shards for i in range(num_shards + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(num_shards)]
+
+def filter_log_event_pages(semaphore=None, **filter_args):
+    pages = iter(clients.logs.get_paginator("filter_log_events").paginate(**filter_args))
+    while True:
+        if semaphore is None:
+            page = next(pages, None)
+        else:
+            with semaphore:
+                page = next(pages, None)
+        if page is None:
+            break
+        events = [event for event in page["events"] if "timestamp" in event and "message" in event]
+        for event in events:
+            event["logGroupName"] = filter_args["logGroupName"]
+        yield events
+
+def order_events(pages, stream_index=0):
+    # FilterLogEvents returns events sorted by timestamp, ingestion time and event ID. The stream index and sequence
+    # number break any remaining ties, so the merge never has to compare the event dicts themselves.
+    seq = itertools.count()
+    for page in pages:
+        for event in page:
+            sort_key = event["timestamp"], event.get("ingestionTime", 0), event.get("eventId", "")
+            yield sort_key + (stream_index, next(seq), event)
+
+def filter_log_events(log_groups, shards=1, max_concurrency=8, **filter_args):
+    """
+    Yield events from one or more log groups in timestamp order. When a start time is given and shards > 1, the time
+    range is split into shards. Each log group and shard is searched concurrently (with at most max_concurrency requests
+    in flight). The shards of a log group cover disjoint time ranges, so they are read in full without waiting on the
+    consumer and concatenated in order; the log groups are then merged back into exact timestamp order.
+    """
+    if shards > 1 and "startTime" in filter_args:
+        end_time = filter_args.get("endTime", int(time.time() * 1000))
+        time_ranges = split_time_range(filter_args["startTime"], end_time, shards)
+    else:
+        time_ranges = [(filter_args.get("startTime"), filter_args.get("endTime"))]
+    semaphore = threading.BoundedSemaphore(max_concurrency)
+    parallel = len(log_groups) > 1 or len(time_ranges) > 1
+    streams = []
+    for log_group in log_groups:
+        shard_pages = []
+        for start_time, end_time in time_ranges:
+            shard_args = dict(filter_args, logGroupName=log_group, startTime=start_time, endTime=end_time)
+            pages = filter_log_event_pages(semaphore, **{k: v for k, v in shard_args.items() if v is not None})
+            shard_pages.append(prefetch(pages, max_buffered=None) if parallel else pages)
+        streams.append(order_events(itertools.chain.from_iterable(shard_pages), stream_index=len(streams)))
+    for ordered_event in heapq.merge(*streams):
+        yield ordered_event[-1]
+
+class LogGroupCursor(object):
+    """
+    Tracks the position of a live tail in one log group. Each poll re-reads a short lookback window behind the newest
+    event seen, so that late-arriving events are still picked up; event IDs already seen in that window are skipped.
+    """
+    def __init__(self, log_group, start_time, poll_interval, lookback_ms):
+        self.log_group, self.high_water, self.seen = log_group, start_time, {}
+        self.min_start_time, self.lookback_ms = start_time, lookback_ms
+        self.poll_interval, self.next_poll = poll_interval, 0
+
+    def poll(self, **filter_args):
+        start_time = max(self.min_start_time, self.high_water - self.lookback_ms)
+        events = []
+        for page in filter_log_event_pages(logGroupName=self.log_group, startTime=start_time, **filter_args):
+            events.extend(event for event in page if event.get("eventId") not in self.seen)
+        return events
+
+    def advance(self, events, poll_interval, max_poll_interval):
+        for event in events:
+            self.seen[event.get("eventId")] = event["timestamp"]
+            self.high_water = max(self.high_water, event["timestamp"])
+        self.seen = {k: v for k, v in self.seen.items() if v >= self.high_water - self.lookback_ms}
+        # Back off exponentially on log groups that have gone quiet, so that idle groups cost few requests
+        self.poll_interval = poll_interval if events else min(self.poll_interval * 2, max_poll_interval)
+        self.next_poll = time.time() + self.poll_interval
+
+def follow_log_events(log_groups, start_time, poll_interval=1, max_poll_interval=16, reorder_window=2,
+                      max_buffered=10000, **filter_args):
+    """
+    Tail one or more log groups, yielding new events as one stream. All due log groups are polled concurrently on each
+    tick. Events are held in a reorder buffer for reorder_window seconds (or until more than max_buffered events are
+    held) and released in timestamp order, so that events from different groups interleave correctly.
+    """
+    cursors = [LogGroupCursor(g, start_time, poll_interval, reorder_window * 1000) for g in log_groups]
+    buffered, seq = [], itertools.count()
+    with ThreadPoolExecutor(max_workers=min(len(cursors), 8)) as executor:
+        while True:
+            due = [cursor for cursor in cursors if cursor.next_poll <= time.time()]
+            for cursor, events in zip(due, executor.map(lambda cursor: cursor.poll(**filter_args), due)):
+                cursor.advance(events, poll_interval, max_poll_interval)
+                received_at = time.time()
+                for event in events:
+                    heapq.heappush(buffered, (event["timestamp"], next(seq), received_at, event))
+            release_before = time.time() - reorder_window
+            while buffered and (buffered[0][2] <= release_before or len(buffered) > max_buffered):
+                yield heapq.heappop(buffered)[-1]
+            time.sleep(max(0, min([poll_interval] + [cursor.next_poll - time.time() for cursor in cursors])))
+
+class LogWriter(object):
+    """
+    Buffered writer for log events. In "iso" mode (the default), each line is the event timestamp followed by the
+    message; the timestamp is formatted directly from epoch milliseconds, and the formatted prefix is reused for all
+    events within the same second. "raw" mode writes the message only, and "ndjson" mode writes each event as a JSON
+    object. Output is accumulated and written in blocks of at least buffer_size characters; set buffer_size to 0 to
+    flush after every event.
+    """
+    modes = ("iso", "raw", "ndjson")
+
+    def __init__(self, stream=None, mode="iso", buffer_size=65536):
+        self.stream = sys.stdout if stream is None else stream
+        self.mode, self.buffer_size = mode, buffer_size
+        self.buf, self.buf_len = [], 0
+        self.prefix_second, self.prefix = None, None
+
+    def format_timestamp(self, timestamp):
+        second = timestamp // 1000
+        if second != self.prefix_second:
+            self.prefix_second = second
+            self.prefix = time.strftime("%Y-%m-%d %H:%M:%S+00:00 ", time.gmtime(second))
+        return self.prefix
+
+    def write(self, event, source=None):
+        if self.mode == "ndjson":
+            line = json.dumps(event) + "\n"
+        else:
+            line = event["message"] + "\n"
+            if source is not None:
+                line = source + " " + line
+            if self.mode == "iso":
+                line = self.format_timestamp(event["timestamp"]) + line
+        self.buf.append(line)
+        self.buf_len += len(line)
+        if self.buf_len >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            content = "".join(self.buf)
+            self.stream.write(content.encode("utf-8") if USING_PYTHON2 else content)
+            self.buf, self.buf_len = [], 0
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+def add_log_format_arg(parser):
+    parser.add_argument("--format", choices=LogWriter.modes, default="iso",
+                        help="Print each event as a timestamp and message (iso), message only (raw), or JSON (ndjson)")
@@ -0,0 +1,37 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, re, json, gzip, tempfile
+
+from dateutil.parser import parse as parse_datetime
+
+from .compat import str
+
+def parse_timestamp(value):
+    # Datetimes are stored as str(datetime), so that they round-trip for relative time formatting
+    if isinstance(value, str) and re.match(r"^\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d", value):
+        return parse_datetime(value)
+    return value
+
+def parse_timestamps(obj):
+    return {k: [parse_timestamp(i) for i in v] if isinstance(v, list) else parse_timestamp(v) for k, v in obj.items()}
+
+class JSONCache(dict):
+    """
+    A dict that is loaded from, and saved to, a gzipped JSON file in the aegea user config directory. Saves replace the
+    file atomically, so concurrent aegea processes never read a partially written cache. Datetimes are saved as strings
+    and parsed back when the cache is loaded.
+    """
+    def __init__(self, name):
+        from .. import config
+        self.filename = os.path.join(config.user_config_dir, name + ".json.gz")
+        try:
+            with gzip.open(self.filename) as fh:
+                self.update(json.loads(fh.read().decode("utf-8"), object_hook=parse_timestamps))
+        except (IOError, OSError, ValueError):
+            pass
+
+    def save(self):
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+        with os.fdopen(fd, "wb") as raw_fh, gzip.GzipFile(fileobj=raw_fh, mode="wb") as fh:
+            fh.write(json.dumps(self, default=str).encode("utf-8"))
+        os.rename(tmp_filename, self.filename)
@@ -7,7 +7,7 @@ from .. import logger
 from . import gzip_compress_bytes
 from .compat import StringIO
 from .crypto import get_public_key_from_pair
-from .aws import ensure_s3_bucket, clients
+from .aws import ensure_s3_bucket, clients, EnsuredResources
 
 def add_file_to_cloudinit_manifest(src_path, path, manifest):
     with open(src_path, "rb") as fh:
@@ -91,7 +91,8 @@ def upload_bootstrap_asset(cloud_config_data, rootfs_skel_dirs):
     cipher = subprocess.Popen(["openssl", "aes-256-cbc", "-e", "-k", enc_key],
                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     encrypted_tarfile = cipher.communicate(get_bootstrap_files(rootfs_skel_dirs, dest="tarfile"))[0]
-    bucket.upload_fileobj(io.BytesIO(encrypted_tarfile), key_name)
+    with EnsuredResources.verify_on_error():
+        bucket.upload_fileobj(io.BytesIO(encrypted_tarfile), key_name)
     url = clients.s3.generate_presigned_url(ClientMethod='get_object', Params=dict(Bucket=bucket.name, Key=key_name))
     cmd = "curl -s '{url}' | openssl aes-256-cbc -d -k {key} | tar -xz --no-same-owner -C /"
     cloud_config_data["runcmd"].insert(0, cmd.format(url=url, key=enc_key))
@@ -12,6 +12,8 @@ if USING_PYTHON2:
     from ..packages.backports.shutil_get_terminal_size import get_terminal_size
     from ..packages.backports.tempfile import TemporaryDirectory
     import subprocess32 as subprocess
+    import Queue as queue
+    from pipes import quote as shell_quote
 
     def makedirs(name, mode=0o777, exist_ok=False):
         try:
@@ -46,6 +48,8 @@ else:
     from shutil import get_terminal_size
     from tempfile import TemporaryDirectory
     import subprocess
+    import queue
+    from shlex import quote as shell_quote
     from os import makedirs
     from statistics import median
     timestamp = datetime.datetime.timestamp
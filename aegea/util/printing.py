@@ -1,7 +1,8 @@
 # coding: utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, json, shutil, subprocess, re, errno
+import os, sys, json, shutil, subprocess, re, errno, threading, collections
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from .exceptions import GetFieldError, AegeaException
 from .compat import str, get_terminal_size
@@ -148,6 +149,8 @@ def format_table(table, column_names=None, column_specs=None, max_col_width=32,
     return "\n".join(formatted_table)
 
 def page_output(content, pager=None, file=None):
+    if content is None:
+        return
     if file is None:
         file = sys.stdout
     if not content.endswith("\n"):
@@ -254,15 +257,39 @@ def format_number(n, fractional_digits=2):
     elif TB <= B:
         return '{0:.{precision}f}T'.format(B / TB, precision=fractional_digits)
 
+row_collector = threading.local()
+RowCollector = collections.namedtuple("RowCollector", "rows columns")
+
+@contextmanager
+def collect_rows():
+    """
+    While this context manager is active, tabulate() calls in the current thread add their rows to the yielded
+    collector instead of formatting them (and return None, which page_output() ignores). This is used to merge the
+    output of a listing command run in several regions into one table.
+    """
+    collector = row_collector.collector = RowCollector(rows=[], columns=[])
+    try:
+        yield collector
+    finally:
+        row_collector.collector = None
+
 def tabulate(collection, args, cell_transforms=None):
     if cell_transforms is None:
         cell_transforms = {}
     cell_transforms["tags"] = format_tags
+    table = [[get_cell(i, f, cell_transforms.get(f)) for f in args.columns] for i in collection]
+    collector = getattr(row_collector, "collector", None)
+    if collector is not None:
+        collector.rows.extend(table)
+        collector.columns[:] = args.columns
+        return None
+    return format_cells(table, args)
+
+def format_cells(table, args):
     if getattr(args, "json", None):
-        table = [{f: get_cell(i, f, cell_transforms.get(f)) for f in args.columns} for i in collection]
+        table = [dict(zip(args.columns, row)) for row in table]
         return json.dumps(table, indent=2, default=lambda x: str(x))
     else:
-        table = [[get_cell(i, f, cell_transforms.get(f)) for f in args.columns] for i in collection]
         if getattr(args, "sort_by", None):
             reverse = False
             if args.sort_by.endswith(":reverse"):
@@ -43,6 +43,7 @@ setuptools.setup(
     extras_require={
         ':python_version == "2.7"': [
             "enum34 >= 1.1.6, < 2",
+            "futures >= 3.2.0, < 4",
             "ipaddress >= 1.0.19, < 2",
             "subprocess32 >= 3.2.7, < 4"
         ]
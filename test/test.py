@@ -4,6 +4,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os, sys, unittest, collections, itertools, copy, re, subprocess, importlib, pkgutil, json, datetime, glob
+import heapq, io
 
 pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, pkg_root)
@@ -13,6 +14,10 @@ from aegea.util.cloudinit import get_user_data
 from aegea.util.aws import (resolve_ami, IAMPolicyBuilder, locate_ami, get_ondemand_price_usd, ARN, DNSZone,
                             get_public_ip_ranges)
 from aegea.util.aws.spot import SpotFleetBuilder
+from aegea.util.aws.logs import split_time_range, order_events, LogWriter
+from aegea.util.aws.index import ResourceIndex, OfflineResource
+from aegea.util.aws.batch import JobStore
+from aegea.util.cache import parse_timestamps
 from aegea.util.exceptions import AegeaException
 from aegea.util.compat import USING_PYTHON2, str
 from aegea.util.git import private_submodules
@@ -198,6 +203,211 @@ class TestAegea(unittest.TestCase):
             with self.assertRaises(Exception):
                 print(Timestamp(invalid_input))
 
+    def test_log_shard_merge(self):
+        self.assertEqual(split_time_range(0, 9, 3), [(0, 2), (3, 5), (6, 9)])
+        self.assertEqual(split_time_range(5, 6, 8), [(5, 5), (6, 6)])
+        self.assertEqual(split_time_range(5, 5, 1), [(5, 5)])
+        events = [dict(timestamp=t, message=str(t), eventId=str(i)) for i, t in enumerate([1, 2, 2, 3, 5, 8, 8, 9])]
+        shards = [[[e for e in events if lo <= e["timestamp"] <= hi]] for lo, hi in split_time_range(0, 9, 3)]
+        merged = heapq.merge(*[order_events(pages, i) for i, pages in enumerate(shards)])
+        self.assertEqual([e[-1] for e in merged], events)
+
+    def test_log_writer(self):
+        events = [dict(timestamp=1466533609099, message="a"), dict(timestamp=1466533609999, message="b"),
+                  dict(timestamp=1466533610000, message="c")]
+        for mode, expected in (("iso", str(Timestamp(events[0]["timestamp"])) + " a\n"), ("raw", "a\n"),
+                               ("ndjson", json.dumps(events[0]) + "\n")):
+            buf = io.StringIO()
+            with LogWriter(buf, mode=mode) as writer:
+                for event in events:
+                    writer.write(event)
+                self.assertEqual(buf.getvalue(), "")
+            self.assertEqual(buf.getvalue().splitlines(True)[0], expected)
+        buf = io.StringIO()
+        with LogWriter(buf, buffer_size=0) as writer:
+            writer.write(events[2], source="g:s")
+            self.assertEqual(buf.getvalue(), "2016-06-21 18:26:50+00:00 g:s c\n")
+
+    def test_resource_index(self):
+        index = ResourceIndex(":memory:")
+        index.region = "us-east-1"
+        instances = [dict(InstanceId="i-{}".format(i), InstanceType="t2.micro" if i % 2 else "m5.large",
+                          LaunchTime=datetime.datetime(2018, 1, 1 + i),
+                          State=dict(Name="running" if i < 3 else "stopped"),
+                          Tags=[dict(Key="Name", Value="host{}".format(i))]) for i in range(5)]
+        index.save("ec2.Instance", "123456789012", instances)
+        results = index.query("ec2.Instance", filters=[["state", "running"]], sort_by="launch_time:reverse")
+        self.assertEqual([r["id"] for r in results], ["i-2", "i-1", "i-0"])
+        results = index.query("ec2.Instance", filters=[["instance-type", "t2.micro"]], limit=1)
+        self.assertEqual([r["id"] for r in results], ["i-1"])
+        self.assertEqual([r["name"] for r in index.query("ec2.Instance", tags=[["Name", "host4"]])], ["host4"])
+        instance = OfflineResource("ec2.Instance", results[0]["id"], results[0]["data"])
+        self.assertEqual(instance.launch_time, datetime.datetime(2018, 1, 2))
+        self.assertEqual(instance.public_dns_name, None)
+        with self.assertRaises(AegeaException):
+            index.query("ec2.Image")
+
+    def test_json_cache_timestamps(self):
+        entry = dict(registeredAt=datetime.datetime(2018, 1, 2, 3, 4, 5), revision=3, name="2018",
+                     times=[datetime.datetime(2018, 1, 1)])
+        loaded = json.loads(json.dumps(dict(taskdef=entry), default=str), object_hook=parse_timestamps)
+        self.assertEqual(loaded["taskdef"], entry)
+
+    def test_job_store(self):
+        job_store = JobStore(":memory:")
+        job_store.region = "us-east-1"
+        jobs = [dict(jobId="job{}".format(i), jobQueue="arn:aws:batch:us-east-1:123456789012:job-queue/q",
+                     status="SUCCEEDED" if i % 2 else "FAILED", createdAt=i) for i in range(4)]
+        job_store.save(jobs)
+        self.assertEqual(job_store.describe(["job3", "job0"]), [jobs[3], jobs[0]])
+        self.assertEqual(job_store.query(["q"], ["SUCCEEDED"]), [jobs[1], jobs[3]])
+        self.assertEqual(job_store.query(["other"], ["SUCCEEDED", "FAILED"]), [])
+        self.assertEqual(job_store.query(["q"], ["SUCCEEDED", "FAILED"], created_after=2), [jobs[2], jobs[3]])
+
+        class MemoryJobArchive(dict):
+            def append(self, jobs):
+                self["segment{}".format(len(self))] = jobs
+                return "segment{}".format(len(self) - 1)
+
+            def list_segments(self, start_after=None):
+                return sorted(key for key in self if start_after is None or key > start_after)
+
+            read_segment = dict.__getitem__
+
+        job_store.archive = MemoryJobArchive()
+        job_store.archive_jobs(jobs[:2])
+        job_store.archive_jobs(jobs)
+        self.assertEqual([job_store.archive[key] for key in sorted(job_store.archive)], [jobs[:2], jobs[2:]])
+        other_job_store = JobStore(":memory:", archive=job_store.archive)
+        other_job_store.region = "us-east-1"
+        self.assertEqual(other_job_store.sync_archive(), 4)
+        self.assertEqual(other_job_store.sync_archive(), 0)
+        self.assertEqual(other_job_store.describe(["job2"]), [jobs[2]])
+        # A segment written elsewhere with an earlier key than this store's own latest append is still loaded
+        late_job = dict(jobs[0], jobId="job4")
+        other_job_store.archive_jobs([dict(jobs[0], jobId="job5")])
+        other_job_store.archive["segment1a"] = [late_job]
+        self.assertEqual(other_job_store.sync_archive(), 1)
+        self.assertEqual(other_job_store.describe(["job4"]), [late_job])
+        # Stored jobs in terminal states are archived once, and jobs loaded from the archive are not archived again
+        other_job_store.save([dict(jobs[1], jobId="job6"), dict(jobs[1], jobId="job7", status="RUNNING")])
+        self.assertEqual(other_job_store.archive_stored_jobs(), 1)
+        self.assertEqual(other_job_store.archive_stored_jobs(), 0)
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy") if hasattr(importlib, "util") else False, "requires NumPy")
+    def test_batch_job_stats(self):
+        from aegea.batch import get_job_stats
+        jobs = [dict(status="SUCCEEDED", createdAt=0, startedAt=10000 * i, stoppedAt=10000 * i + 20000,
+                     container=dict(vcpus=2)) for i in range(1, 5)]
+        jobs.append(dict(status="FAILED", createdAt=0, statusReason="Dependent job failed"))
+        stats = get_job_stats(jobs)
+        self.assertEqual((stats["jobs"], stats["failed"], stats["failure_rate"]), (5, 1, 0.2))
+        self.assertEqual(stats["queue_wait"]["max"], 40)
+        self.assertEqual(stats["run_time"]["p50"], 20)
+        self.assertEqual(stats["throughput_per_hour"], dict(mean=4, peak=4))
+        self.assertEqual((stats["peak_running_jobs"], stats["peak_running_vcpus"]), (2, 4))
+        self.assertEqual(stats["failure_reasons"], {"Dependent job failed": 1})
+
+    def test_batch_advise_helpers(self):
+        from aegea.batch import get_container_resource, get_instance_type_catalog
+        self.assertEqual(get_container_resource(dict(vcpus=4, memory=8000), "VCPU"), 4)
+        self.assertEqual(get_container_resource(dict(vcpus=4, memory=8000), "MEMORY"), 8000)
+        container = dict(resourceRequirements=[dict(type="VCPU", value="2"), dict(type="MEMORY", value="1024")])
+        self.assertEqual((get_container_resource(container, "VCPU"), get_container_resource(container, "MEMORY")),
+                         (2, 1024))
+        self.assertEqual(get_instance_type_catalog(["c4.large"]), {"c4.large": (2, 3.75 * 1024)})
+        self.assertIn("r4.large", get_instance_type_catalog(["optimal"]))
+        self.assertEqual(get_instance_type_catalog(["m5"]), {})
+
+    def test_batch_manifest_job_args(self):
+        from aegea.batch import submit_parser, get_manifest_job_args
+        args = submit_parser.parse_args(["--command", "echo hi", "--environment", "A=1"])
+        entry = dict(vcpus="", memory_mb="2048", privileged="yes", command="echo $B", B="2", C="")
+        job_args = get_manifest_job_args(args, entry)
+        self.assertEqual((job_args.vcpus, job_args.memory, job_args.privileged), (1, 2048, True))
+        self.assertEqual(job_args.command, ["echo $B"])
+        self.assertEqual(job_args.environment, [dict(name="A", value="1"), dict(name="B", value="2")])
+        self.assertEqual(args.environment, [dict(name="A", value="1")])
+        with self.assertRaises(ValueError):
+            get_manifest_job_args(args, dict(vcpus="two"))
+
+    def test_batch_workflow_layers(self):
+        from aegea.batch import get_workflow_layers, reduce_dependencies, max_job_dependencies
+        workflow_jobs = dict(a=[], b=["a"], c=["a"], d=["b", "c", "b"], e=[])
+        self.assertEqual(get_workflow_layers(workflow_jobs), [["a", "e"], ["b", "c"], ["d"]])
+        with self.assertRaises(AegeaException):
+            get_workflow_layers(dict(a=["c"], b=["a"], c=["b"], d=[]))
+        with self.assertRaises(AegeaException):
+            get_workflow_layers(dict(a=["z"]))
+        barriers = []
+
+        def submit_barrier(chunk):
+            self.assertLessEqual(len(chunk), max_job_dependencies)
+            barriers.append(chunk)
+            return "barrier{}".format(len(barriers))
+        self.assertEqual(reduce_dependencies(["job1"], submit_barrier), ["job1"])
+        self.assertEqual(barriers, [])
+        depends_on = ["job{}".format(i) for i in range(max_job_dependencies * max_job_dependencies + 1)]
+        self.assertEqual(reduce_dependencies(depends_on, submit_barrier), ["barrier22", "barrier23"])
+        self.assertEqual(sum(barriers[:21], []), depends_on)
+        self.assertEqual(barriers[21:], [["barrier{}".format(i) for i in range(1, 21)], ["barrier21"]])
+
+    def test_batch_array_index_shellcode(self):
+        from aegea.batch import get_array_index_shellcode
+        environment = [dict(name="INPUT", value="s3://bucket/part{array_index}.gz"), dict(name="OTHER", value="x")]
+        shellcode = get_array_index_shellcode(environment)
+        self.assertEqual(len(shellcode), 1)
+        script = "; ".join(shellcode + ['echo "$INPUT"'])
+        for array_index, expect in ("7", "s3://bucket/part7.gz\n"), (None, "s3://bucket/part0.gz\n"):
+            env = dict(os.environ, INPUT=environment[0]["value"])
+            env.pop("AWS_BATCH_JOB_ARRAY_INDEX", None)
+            if array_index is not None:
+                env.update(AWS_BATCH_JOB_ARRAY_INDEX=array_index)
+            self.assertEqual(subprocess.check_output(["bash", "-c", script], env=env).decode(), expect)
+
+    def test_batch_storage_spec(self):
+        from aegea.batch import parse_storage_spec, get_ebs_vol_mgr_shellcode, get_storage_pool_name
+        import argparse
+        self.assertEqual(parse_storage_spec("/mnt=500GB"),
+                         dict(mountpoint="/mnt", size_gb=500, type="st1", iops=None, throughput=None, stripes=1))
+        storage = parse_storage_spec("/scratch=1000,type=gp3,iops=6000,throughput=500,stripes=4")
+        self.assertEqual((storage["type"], storage["iops"], storage["throughput"], storage["stripes"]),
+                         ("gp3", 6000, 500, 4))
+        for spec in ("bad", "/mnt=x", "/mnt=10,foo=1", "/mnt=0", "/mnt=10,stripes=0", "/mnt=10,iops=-1", "/mnt=100",
+                     "/mnt=500,stripes=8", "/mnt=100,type=io1"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_storage_spec(spec)
+        shellcode = "\n".join(get_ebs_vol_mgr_shellcode(storage))
+        self.assertIn("--size 250 --volume-type gp3 --iops 6000 --throughput 500", shellcode)
+        self.assertIn("blockdev --setra 1024 ", shellcode)
+        self.assertIn(" lsof mdadm\n", shellcode)
+        self.assertIn("pool=\n", shellcode)
+        shellcode = "\n".join(get_ebs_vol_mgr_shellcode(parse_storage_spec("/mnt=500"), use_storage_pool=True))
+        self.assertIn("--size 500 --volume-type st1", shellcode)
+        self.assertIn("blockdev --setra 2048 ", shellcode)
+        self.assertNotIn("mdadm\n", shellcode)
+        self.assertIn("pool=st1-500\n", shellcode)
+        self.assertEqual(get_storage_pool_name(100, "io1", iops=3000), "io1-100-3000iops")
+        self.assertEqual(parse_storage_spec("/mnt=100,type=io1,iops=3000")["iops"], 3000)
+        with self.assertRaises(AegeaException):
+            get_ebs_vol_mgr_shellcode(storage, use_storage_pool=True)
+
+    @unittest.skipIf(USING_PYTHON2, "requires threading.Barrier")
+    def test_launch_preflight_steps(self):
+        from aegea.launch import run_preflight_steps
+        import threading
+        # Steps a and b can only pass the barrier if they run concurrently
+        barrier = threading.Barrier(2)
+        steps = collections.OrderedDict([
+            ("a", ((), lambda: barrier.wait(5))),
+            ("b", ((), lambda: barrier.wait(5))),
+            ("c", (("a", "b"), lambda a, b: sorted([a, b])))
+        ])
+        self.assertEqual(run_preflight_steps(steps)["c"], [0, 1])
+        steps["d"] = (("c",), lambda c: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            run_preflight_steps(steps)
+
     @unittest.skipIf(USING_PYTHON2, "requires Python 3 dependencies")
     def test_deploy_utils(self):
         deploy_utils_bindir = os.path.join(pkg_root, "aegea", "rootfs.skel", "usr", "bin")